@@ -0,0 +1,66 @@
+"""
+قياس استهلاك الذاكرة لكل مستخدم: dict بشكل users.json مقابل UserRecord.
+
+    python bench_user_records.py [عدد المستخدمين]
+
+النصوص (الاسم واليوزر) مشتركة بين الحالتين، فالفرق هو كلفة البنية نفسها.
+"""
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp())
+
+from main import UserRecord  # noqa: E402
+
+
+def make_user(i: int) -> dict:
+    verified = random.random() < 0.6
+    return {
+        "id": 100_000_000 + i,
+        "username": f"user{i}" if random.random() < 0.7 else "",
+        "full_name": f"User Number {i}",
+        "referred_by": 100_000_000 + random.randrange(i) if i and random.random() < 0.3 else None,
+        "pending_referrer_id": None,
+        "referrals": [],
+        "points": random.randrange(50),
+        "total_points_earned": random.randrange(100),
+        "redeem_count": random.randrange(3),
+        "joined": True,
+        "human_verified": verified,
+        "referral_counted": verified and random.random() < 0.5,
+        "referral_reward_reverted": False,
+        "captcha_question": "",
+        "captcha_answer": None,
+    }
+
+
+def measure(build) -> int:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del obj
+    return after - before
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    random.seed(1)
+    raw = [make_user(i) for i in range(count)]
+
+    # نعيد بناء كل شيء داخل القياس كما يحدث عند تحميل الملف
+    as_dicts = measure(lambda: {str(u["id"]): dict(u, referrals=list(u["referrals"])) for u in raw})
+    as_records = measure(lambda: {u["id"]: UserRecord.from_dict(u) for u in raw})
+
+    print(f"users: {count}")
+    print(f"dict per user:       {as_dicts / count:8.1f} bytes")
+    print(f"UserRecord per user: {as_records / count:8.1f} bytes")
+    print(f"saving:              {100 * (1 - as_records / as_dicts):8.1f} %")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,83 @@
+import asyncio
+import bisect
+import concurrent.futures
+import hashlib
+import heapq
+import hmac
 import json
+import logging
 import os
 import random
 import re
+import signal
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 from pathlib import Path
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CallbackQueryHandler,
+    ChatMemberHandler,
     CommandHandler,
     ContextTypes,
     MessageHandler,
     filters,
 )
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID_RAW = os.getenv("ADMIN_ID")  # ضعه في Variables على Railway
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL")  # لخادم Bot API محلي أو لأداة الاختبار
+
+# اتصالات Bot API: مجمع للطلبات العادية (الردود والإذاعة وget_chat_member) ومجمع مستقل لـ getUpdates
+BOT_API_POOL_SIZE = int(os.getenv("BOT_API_POOL_SIZE", "256"))
+BOT_API_GET_UPDATES_POOL_SIZE = int(os.getenv("BOT_API_GET_UPDATES_POOL_SIZE", "1"))
+BOT_API_CONNECT_TIMEOUT = float(os.getenv("BOT_API_CONNECT_TIMEOUT", "5"))  # بالثواني
+BOT_API_READ_TIMEOUT = float(os.getenv("BOT_API_READ_TIMEOUT", "5"))
+BOT_API_WRITE_TIMEOUT = float(os.getenv("BOT_API_WRITE_TIMEOUT", "5"))
+BOT_API_MEDIA_WRITE_TIMEOUT = float(os.getenv("BOT_API_MEDIA_WRITE_TIMEOUT", "20"))
+BOT_API_POOL_TIMEOUT = float(os.getenv("BOT_API_POOL_TIMEOUT", "5"))  # انتظار اتصال حر من المجمع
+BOT_API_HTTP2 = os.getenv("BOT_API_HTTP2", "0").strip().lower() in {"1", "true", "yes", "on"}
+
+# وضع Webhook يُفعَّل بوجود WEBHOOK_URL (العنوان العام للخدمة)، وإلا يعمل البوت بالـ polling
+WEBHOOK_URL = (os.getenv("WEBHOOK_URL") or "").rstrip("/")
+WEBHOOK_PATH = (os.getenv("WEBHOOK_PATH") or "telegram").strip("/")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+HEALTH_PATH = "/healthz"
+
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+# replay: معالجة ما وصل أثناء توقف البوت عند التشغيل | drop: تجاهله
+STARTUP_UPDATES = (os.getenv("STARTUP_UPDATES") or "replay").strip().lower()
+STALE_CALLBACK_SECONDS = float(os.getenv("STALE_CALLBACK_SECONDS", "60"))
+UPDATE_OFFSET_SAVE_INTERVAL = float(os.getenv("UPDATE_OFFSET_SAVE_INTERVAL", "5"))  # بالثواني
+
 FACTOR = Decimal("100")  # حذف صفرين
 MODE_KEY = "mode"        # old_to_new | new_to_old
 
-# إشعار دخول المستخدم (مرة واحدة لكل تشغيل للبوت)
-NOTIFIED_USERS = set()
-
 # ================= ملفات التخزين =================
-DATA_DIR = Path("/data")
+DATA_DIR = Path(os.getenv("DATA_DIR") or "/data")
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
 USERS_FILE = DATA_DIR / "users.json"
 CONFIG_FILE = DATA_DIR / "config.json"
 REWARDS_FILE = DATA_DIR / "rewards.json"
 PENDING_REDEEMS_FILE = DATA_DIR / "pending_redeems.json"
+BLOCKLIST_FILE = DATA_DIR / "blocklist.log"
+BROADCASTS_FILE = DATA_DIR / "broadcasts.json"
+SCHEDULES_FILE = DATA_DIR / "schedules.json"
+UPDATE_OFFSET_FILE = DATA_DIR / "update_offset.json"
+NOTIFICATIONS_FILE = DATA_DIR / "notifications.json"
+MAX_BAN_FILE_SIZE = 20 * 1024 * 1024  # حد التحميل في Bot API
 
 # ================= مفاتيح الحالات =================
 ADMIN_ACTION_KEY = "admin_action"
@@ -38,7 +85,10 @@ REFERRAL_ACTION_KEY = "referral_action"
 
 ADMIN_WAIT_BAN = "admin_wait_ban"
 ADMIN_WAIT_UNBAN = "admin_wait_unban"
+ADMIN_WAIT_BAN_FILE = "admin_wait_ban_file"
 ADMIN_WAIT_BROADCAST = "admin_wait_broadcast"
+ADMIN_WAIT_BROADCAST_SEGMENT_VALUE = "admin_wait_broadcast_segment_value"
+ADMIN_WAIT_BROADCAST_TIME = "admin_wait_broadcast_time"
 ADMIN_WAIT_REWARD_POINTS = "admin_wait_reward_points"
 ADMIN_WAIT_ADD_ITEM_NAME = "admin_wait_add_item_name"
 ADMIN_WAIT_ADD_ITEM_COST = "admin_wait_add_item_cost"
@@ -98,33 +148,1232 @@ def _write_json(path: Path, data):
     tmp_path.replace(path)
 
 
-def load_users() -> dict:
-    data = _read_json(USERS_FILE, {"users": {}})
-    if "users" not in data or not isinstance(data["users"], dict):
-        data = {"users": {}}
-    return data
+# ================= خيط الكتابة =================
+class StorageWriter:
+    """
+    خيط واحد تمر عبره كل عمليات الكتابة على التخزين: تُنفذ بنفس ترتيب إرسالها،
+    والـ event loop لا ينتظر القرص. ما يُرسل إليه يجب أن يكون لقطة لا تتغير بعد الإرسال.
+    """
 
+    def __init__(self):
+        self._executor: concurrent.futures.ThreadPoolExecutor | None = None
+        self.submitted = 0  # يُزاد من خيط الـ loop فقط
+        self.completed = 0  # يُزاد من خيط الكتابة فقط
 
-def save_users(data: dict):
-    _write_json(USERS_FILE, data)
+    def submit(self, fn, *args) -> concurrent.futures.Future:
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+        self.submitted += 1
+        return self._executor.submit(self._run, fn, args)
 
+    def _run(self, fn, args):
+        try:
+            return fn(*args)
+        except Exception:
+            logger.exception("Storage write failed: %s", getattr(fn, "__qualname__", fn))
+            raise
+        finally:
+            self.completed += 1
+
+    def idle(self) -> bool:
+        return self.completed >= self.submitted
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+WRITER = StorageWriter()
+
+
+# ================= طبقة التخزين =================
+STORAGE_BACKEND = (os.getenv("STORAGE_BACKEND") or "json").strip().lower()  # json | sqlite
+SQLITE_FILE = DATA_DIR / "bot.sqlite3"
+
+_USER_COLUMNS = (
+    "id",
+    "username",
+    "full_name",
+    "referred_by",
+    "pending_referrer_id",
+    "points",
+    "total_points_earned",
+    "redeem_count",
+    "joined",
+    "human_verified",
+    "referral_counted",
+    "referral_reward_reverted",
+    "announced",
+    "captcha_question",
+    "captcha_answer",
+)
+_USER_BOOL_COLUMNS = ("joined", "human_verified", "referral_counted", "referral_reward_reverted", "announced")
+
+
+class JsonStorage:
+    """التخزين الأصلي: كل ملف JSON مستند كامل يُعاد كتابته عند التعديل."""
+
+    name = "json"
+
+    def __init__(self):
+        # آخر to_dict لكل مستخدم؛ يُستبدل القاموس ولا يُعدَّل، فيُسلَّم لخيط الكتابة بنسخة سطحية
+        self._user_dicts: dict[int, dict] | None = None
+
+    def load_users(self) -> tuple[dict[str, dict], dict]:
+        self._user_dicts = None
+        data = _read_json(USERS_FILE, {"users": {}})
+        if not isinstance(data, dict) or not isinstance(data.get("users"), dict):
+            return {}, {}
+        meta = {k: v for k, v in data.items() if k != "users"}
+        return data["users"], meta
+
+    def snapshot_users(self, store: "UserStore", dirty: set[int]):
+        store.referrals.drain_changes()
+        # to_dict على خيط الـ loop حتى لا يرى خيط الكتابة سجلاً في منتصف تعديله
+        if self._user_dicts is None:
+            self._user_dicts = {}
+            dirty = store.users.keys()
+        for uid in dirty:
+            record = store.users.get(uid)
+            if record is None:
+                self._user_dicts.pop(uid, None)
+            else:
+                self._user_dicts[uid] = record.to_dict([])
+        children = {referrer_id: list(kids) for referrer_id, kids in store.referrals.children.items()}
+        return dict(self._user_dicts), children, dict(store.meta)
+
+    def write_users(self, snapshot):
+        user_dicts, children, meta = snapshot
+        users = {
+            str(uid): {**data, "referrals": children.get(uid, [])} if uid in children else data
+            for uid, data in user_dicts.items()
+        }
+        _write_json(USERS_FILE, {**meta, "users": users})
 
-def load_config() -> dict:
-    data = _read_json(
-        CONFIG_FILE,
-        {
-            "referral_points_per_invite": 1,
-            "blocked_users": [],
-            "forced_sub_channel": "",
-            "forced_sub_link": "",
-            "bot_enabled": True,
-            "referral_enabled": True,
-        },
+    def load_config(self) -> dict:
+        data = _read_json(CONFIG_FILE, {})
+        return data if isinstance(data, dict) else {}
+
+    def save_config(self, data: dict):
+        _write_json(CONFIG_FILE, data)
+
+    def config_version(self):
+        try:
+            st = CONFIG_FILE.stat()
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def list_rewards(self) -> list[dict]:
+        data = _read_json(REWARDS_FILE, {"items": []})
+        items = data.get("items") if isinstance(data, dict) else None
+        return items if isinstance(items, list) else []
+
+    def _save_rewards(self, items: list[dict]):
+        _write_json(REWARDS_FILE, {"items": items})
+
+    def add_reward(self, item: dict):
+        items = self.list_rewards()
+        items.append(item)
+        self._save_rewards(items)
+
+    def update_reward(self, reward_id: int, field: str, value) -> bool:
+        items = self.list_rewards()
+        for item in items:
+            if int(item.get("id", 0)) == int(reward_id):
+                item[field] = value
+                self._save_rewards(items)
+                return True
+        return False
+
+    def delete_reward(self, reward_id: int) -> bool:
+        old_items = self.list_rewards()
+        new_items = [item for item in old_items if int(item.get("id", 0)) != int(reward_id)]
+        if len(new_items) == len(old_items):
+            return False
+        self._save_rewards(new_items)
+        return True
+
+    def load_blocked(self) -> set[int]:
+        # سجل append-only: كل سطر +ID أو -ID، ويُضغط عند التحميل
+        blocked: set[int] = set()
+        lines = 0
+        if BLOCKLIST_FILE.exists():
+            with open(BLOCKLIST_FILE, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    try:
+                        uid = int(line[1:])
+                    except ValueError:
+                        continue
+                    lines += 1
+                    if line[0] == "+":
+                        blocked.add(uid)
+                    elif line[0] == "-":
+                        blocked.discard(uid)
+
+        if lines != len(blocked):
+            tmp_path = BLOCKLIST_FILE.with_suffix(BLOCKLIST_FILE.suffix + ".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.writelines(f"+{uid}\n" for uid in sorted(blocked))
+            tmp_path.replace(BLOCKLIST_FILE)
+        return blocked
+
+    def _append_blocked(self, op: str, ids):
+        with open(BLOCKLIST_FILE, "a", encoding="utf-8") as f:
+            f.writelines(f"{op}{int(uid)}\n" for uid in ids)
+
+    def add_blocked(self, ids):
+        self._append_blocked("+", ids)
+
+    def remove_blocked(self, ids):
+        self._append_blocked("-", ids)
+
+    def load_pending_redeems(self) -> dict[str, dict]:
+        data = _read_json(PENDING_REDEEMS_FILE, {"requests": {}})
+        requests = data.get("requests") if isinstance(data, dict) else None
+        return requests if isinstance(requests, dict) else {}
+
+    def _save_pending_redeems(self, requests: dict[str, dict]):
+        _write_json(PENDING_REDEEMS_FILE, {"requests": requests})
+
+    def get_pending_redeem(self, user_id: int) -> dict | None:
+        return self.load_pending_redeems().get(str(user_id))
+
+    def put_pending_redeem(self, request: dict):
+        requests = self.load_pending_redeems()
+        requests[str(request["user_id"])] = request
+        self._save_pending_redeems(requests)
+
+    def set_pending_redeem_status(self, user_id: int, status: str):
+        requests = self.load_pending_redeems()
+        req = requests.get(str(user_id))
+        if req:
+            req["status"] = status
+            self._save_pending_redeems(requests)
+
+    def remove_pending_redeem(self, user_id: int):
+        requests = self.load_pending_redeems()
+        requests.pop(str(user_id), None)
+        self._save_pending_redeems(requests)
+
+
+class SqliteStorage:
+    """
+    جداول حقيقية بدل المستندات الكاملة: كل تعديل يصبح تحديث صف واحد،
+    والبحث عن مستخدم أو طلب استبدال يتم عبر فهرس.
+    """
+
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL DEFAULT '',
+            full_name TEXT NOT NULL DEFAULT '',
+            referred_by INTEGER,
+            pending_referrer_id INTEGER,
+            points INTEGER NOT NULL DEFAULT 0,
+            total_points_earned INTEGER NOT NULL DEFAULT 0,
+            redeem_count INTEGER NOT NULL DEFAULT 0,
+            joined INTEGER NOT NULL DEFAULT 1,
+            human_verified INTEGER NOT NULL DEFAULT 0,
+            referral_counted INTEGER NOT NULL DEFAULT 0,
+            referral_reward_reverted INTEGER NOT NULL DEFAULT 0,
+            announced INTEGER NOT NULL DEFAULT 0,
+            captcha_question TEXT NOT NULL DEFAULT '',
+            captcha_answer INTEGER,
+            extra TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users(referred_by);
+
+        CREATE TABLE IF NOT EXISTS referrals (
+            referrer_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (referrer_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_referrals_user ON referrals(user_id);
+
+        CREATE TABLE IF NOT EXISTS config (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS rewards (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            cost INTEGER NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS pending_redeems (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL DEFAULT '',
+            full_name TEXT NOT NULL DEFAULT '',
+            reward_id INTEGER NOT NULL,
+            reward_name TEXT NOT NULL,
+            cost INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending'
+        );
+        CREATE INDEX IF NOT EXISTS idx_pending_redeems_status ON pending_redeems(status);
+
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS blocked_users (
+            user_id INTEGER PRIMARY KEY
+        );
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(self.SCHEMA)
+            self._add_missing_columns(conn)
+            self._conn = conn
+        return self._conn
+
+    # أعمدة أُضيفت بعد إنشاء القاعدة: CREATE TABLE IF NOT EXISTS لا يضيفها للجداول الموجودة
+    ADDED_COLUMNS = {"announced": "INTEGER NOT NULL DEFAULT 0"}
+
+    def _add_missing_columns(self, conn: sqlite3.Connection):
+        existing = {row["name"] for row in conn.execute("PRAGMA table_info(users)")}
+        for column, definition in self.ADDED_COLUMNS.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE users ADD COLUMN {column} {definition}")
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # ----- المستخدمون -----
+    @staticmethod
+    def _user_from_row(row: sqlite3.Row) -> dict:
+        user = {col: row[col] for col in _USER_COLUMNS}
+        for col in _USER_BOOL_COLUMNS:
+            user[col] = bool(user[col])
+        if row["extra"]:
+            user.update(json.loads(row["extra"]))
+        return user
+
+    @staticmethod
+    def _user_to_row(user: dict) -> tuple:
+        values = []
+        for col in _USER_COLUMNS:
+            value = user.get(col)
+            if col in _USER_BOOL_COLUMNS:
+                value = int(bool(value if value is not None else col == "joined"))
+            elif col in ("points", "total_points_earned", "redeem_count"):
+                value = int(value or 0)
+            elif col in ("username", "full_name", "captcha_question"):
+                value = value or ""
+            values.append(value)
+        extra = {k: v for k, v in user.items() if k not in _USER_COLUMNS and k != "referrals"}
+        values.append(json.dumps(extra, ensure_ascii=False) if extra else None)
+        return tuple(values)
+
+    def load_users(self) -> tuple[dict[str, dict], dict]:
+        users = {str(row["id"]): self._user_from_row(row) for row in self.conn.execute("SELECT * FROM users")}
+        for user in users.values():
+            user["referrals"] = []
+        for row in self.conn.execute("SELECT referrer_id, user_id FROM referrals ORDER BY referrer_id, position"):
+            referrer = users.get(str(row["referrer_id"]))
+            if referrer is not None:
+                referrer["referrals"].append(row["user_id"])
+        meta = {row["key"]: json.loads(row["value"]) for row in self.conn.execute("SELECT key, value FROM meta")}
+        return users, meta
+
+    def _write_meta(self, meta: dict):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            [(key, json.dumps(value)) for key, value in meta.items()],
+        )
+
+    def _write_users(self, users: list[dict]):
+        placeholders = ", ".join("?" for _ in range(len(_USER_COLUMNS) + 1))
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO users ({', '.join(_USER_COLUMNS)}, extra) VALUES ({placeholders})",
+            [self._user_to_row(user) for user in users],
+        )
+
+    def snapshot_users(self, store: "UserStore", dirty: set[int]):
+        rows = [store.users[uid].to_dict([]) for uid in dirty if uid in store.users]
+        return rows, store.referrals.drain_changes(), dict(store.meta)
+
+    def write_users(self, snapshot):
+        rows, changes, meta = snapshot
+        with self.conn:
+            self._write_users(rows)
+            # الإحالات تُكتب كفروقات (إضافة/حذف صف) بدل إعادة كتابة قائمة المُحيل كاملة
+            for added, referrer_id, user_id, position in changes:
+                if added:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO referrals (referrer_id, user_id, position) VALUES (?, ?, ?)",
+                        (referrer_id, user_id, position),
+                    )
+                else:
+                    self.conn.execute(
+                        "DELETE FROM referrals WHERE referrer_id = ? AND user_id = ?", (referrer_id, user_id)
+                    )
+            self._write_meta(meta)
+
+    # ----- الإعدادات -----
+    def load_config(self) -> dict:
+        return {row["key"]: json.loads(row["value"]) for row in self.conn.execute("SELECT key, value FROM config")}
+
+    def config_version(self):
+        # يتغير فقط عندما يكتب اتصال آخر على قاعدة البيانات
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def save_config(self, data: dict):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value, ensure_ascii=False)) for key, value in data.items()],
+            )
+            self.conn.execute(
+                f"DELETE FROM config WHERE key NOT IN ({', '.join('?' for _ in data)})",
+                tuple(data),
+            )
+
+    # ----- السلع -----
+    def list_rewards(self) -> list[dict]:
+        return [dict(row) for row in self.conn.execute("SELECT id, name, cost FROM rewards ORDER BY id")]
+
+    def add_reward(self, item: dict):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO rewards (id, name, cost) VALUES (?, ?, ?)",
+                (int(item["id"]), item["name"], int(item["cost"])),
+            )
+
+    def update_reward(self, reward_id: int, field: str, value) -> bool:
+        if field not in ("name", "cost"):
+            raise ValueError(f"Unknown reward field: {field}")
+        with self.conn:
+            cur = self.conn.execute(f"UPDATE rewards SET {field} = ? WHERE id = ?", (value, int(reward_id)))
+        return cur.rowcount > 0
+
+    def delete_reward(self, reward_id: int) -> bool:
+        with self.conn:
+            cur = self.conn.execute("DELETE FROM rewards WHERE id = ?", (int(reward_id),))
+        return cur.rowcount > 0
+
+    # ----- المحظورون -----
+    def load_blocked(self) -> set[int]:
+        return {row[0] for row in self.conn.execute("SELECT user_id FROM blocked_users")}
+
+    def add_blocked(self, ids):
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO blocked_users (user_id) VALUES (?)", [(int(u),) for u in ids])
+
+    def remove_blocked(self, ids):
+        with self.conn:
+            self.conn.executemany("DELETE FROM blocked_users WHERE user_id = ?", [(int(u),) for u in ids])
+
+    # ----- طلبات الاستبدال -----
+    def load_pending_redeems(self) -> dict[str, dict]:
+        return {str(row["user_id"]): dict(row) for row in self.conn.execute("SELECT * FROM pending_redeems")}
+
+    def get_pending_redeem(self, user_id: int) -> dict | None:
+        row = self.conn.execute("SELECT * FROM pending_redeems WHERE user_id = ?", (int(user_id),)).fetchone()
+        return dict(row) if row else None
+
+    def put_pending_redeem(self, request: dict):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pending_redeems "
+                "(user_id, username, full_name, reward_id, reward_name, cost, status) "
+                "VALUES (:user_id, :username, :full_name, :reward_id, :reward_name, :cost, :status)",
+                request,
+            )
+
+    def set_pending_redeem_status(self, user_id: int, status: str):
+        with self.conn:
+            self.conn.execute("UPDATE pending_redeems SET status = ? WHERE user_id = ?", (status, int(user_id)))
+
+    def remove_pending_redeem(self, user_id: int):
+        with self.conn:
+            self.conn.execute("DELETE FROM pending_redeems WHERE user_id = ?", (int(user_id),))
+
+    # ----- الاستيراد من JSON -----
+    def import_from(self, source: JsonStorage) -> dict:
+        users, meta = source.load_users()
+        config = source.load_config()
+        rewards = source.list_rewards()
+        requests = source.load_pending_redeems()
+        blocked = source.load_blocked() | {int(uid) for uid in config.pop("blocked_users", None) or []}
+
+        with self.conn:
+            self._write_users(list(users.values()))
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO referrals (referrer_id, user_id, position) VALUES (?, ?, ?)",
+                [
+                    (int(user["id"]), int(child), pos)
+                    for user in users.values()
+                    for pos, child in enumerate(user.get("referrals") or [])
+                ],
+            )
+            self._write_meta(meta)
+            if config:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)",
+                    [(key, json.dumps(value, ensure_ascii=False)) for key, value in config.items()],
+                )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO rewards (id, name, cost) VALUES (?, ?, ?)",
+                [(int(item["id"]), item["name"], int(item["cost"])) for item in rewards],
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO pending_redeems "
+                "(user_id, username, full_name, reward_id, reward_name, cost, status) "
+                "VALUES (:user_id, :username, :full_name, :reward_id, :reward_name, :cost, :status)",
+                [
+                    {
+                        "user_id": int(req.get("user_id") or uid),
+                        "username": req.get("username") or "",
+                        "full_name": req.get("full_name") or "",
+                        "reward_id": int(req.get("reward_id", 0)),
+                        "reward_name": req.get("reward_name") or "",
+                        "cost": int(req.get("cost", 0)),
+                        "status": req.get("status") or "pending",
+                    }
+                    for uid, req in requests.items()
+                ],
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO blocked_users (user_id) VALUES (?)", [(uid,) for uid in blocked]
+            )
+
+        return {
+            "users": len(users),
+            "config": len(config),
+            "rewards": len(rewards),
+            "pending_redeems": len(requests),
+            "blocked_users": len(blocked),
+        }
+
+
+def create_storage(kind: str):
+    if kind == "json":
+        return JsonStorage()
+    if kind == "sqlite":
+        return SqliteStorage(SQLITE_FILE)
+    raise RuntimeError(f"Unknown STORAGE_BACKEND: {kind!r} (expected 'json' or 'sqlite')")
+
+
+STORAGE = create_storage(STORAGE_BACKEND)
+
+
+def import_json_to_sqlite() -> dict:
+    target = SqliteStorage(SQLITE_FILE)
+    try:
+        return target.import_from(JsonStorage())
+    finally:
+        target.close()
+
+
+# ================= مخزن المستخدمين =================
+USERS_FLUSH_INTERVAL = float(os.getenv("USERS_FLUSH_INTERVAL", "5"))  # بالثواني
+
+
+_FLAG_JOINED = 1
+_FLAG_HUMAN_VERIFIED = 2
+_FLAG_REFERRAL_COUNTED = 4
+_FLAG_REFERRAL_REWARD_REVERTED = 8
+_FLAG_ANNOUNCED = 16  # أُرسل تنبيه دخوله للأدمن
+
+_FLAG_FIELDS = (
+    ("joined", _FLAG_JOINED),
+    ("human_verified", _FLAG_HUMAN_VERIFIED),
+    ("referral_counted", _FLAG_REFERRAL_COUNTED),
+    ("referral_reward_reverted", _FLAG_REFERRAL_REWARD_REVERTED),
+    ("announced", _FLAG_ANNOUNCED),
+)
+
+
+def _flag_property(bit: int) -> property:
+    def getter(self) -> bool:
+        return bool(self.flags & bit)
+
+    def setter(self, value: bool):
+        if value:
+            self.flags |= bit
+        else:
+            self.flags &= ~bit
+
+    return property(getter, setter)
+
+
+class UserRecord:
+    """
+    تمثيل مضغوط لسجل المستخدم في الذاكرة: __slots__ بدل dict بـ 15 مفتاحاً،
+    والقيم المنطقية مجمّعة في عدد صحيح واحد. يتحول من/إلى شكل JSON الحالي.
+    """
+
+    __slots__ = (
+        "id",
+        "username",
+        "full_name",
+        "referred_by",
+        "pending_referrer_id",
+        "points",
+        "total_points_earned",
+        "redeem_count",
+        "points_seq",
+        "flags",
+        "captcha_question",
+        "captcha_answer",
+        "inactive_since",
+        "last_seen",
+        "extra",
     )
+
+    joined = _flag_property(_FLAG_JOINED)
+    human_verified = _flag_property(_FLAG_HUMAN_VERIFIED)
+    referral_counted = _flag_property(_FLAG_REFERRAL_COUNTED)
+    referral_reward_reverted = _flag_property(_FLAG_REFERRAL_REWARD_REVERTED)
+    announced = _flag_property(_FLAG_ANNOUNCED)
+
+    def __init__(self, user_id: int, username: str = "", full_name: str = ""):
+        self.id = int(user_id)
+        self.username = username
+        self.full_name = full_name
+        self.referred_by = None
+        self.pending_referrer_id = None
+        self.points = 0
+        self.total_points_earned = 0
+        self.redeem_count = 0
+        self.points_seq = 0  # آخر قيد من سجل النقاط دخل في points
+        self.flags = _FLAG_JOINED
+        self.captcha_question = ""
+        self.captcha_answer = None
+        self.inactive_since: int | None = None  # وقت اكتشاف أنه حظر البوت أو حذف حسابه
+        self.last_seen: int | None = None  # يُحدَّث مرة واحدة يومياً على الأكثر
+        self.extra: dict | None = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "UserRecord":
+        record = cls(data["id"], data.get("username") or "", data.get("full_name") or "")
+        record.referred_by = data.get("referred_by")
+        record.pending_referrer_id = data.get("pending_referrer_id")
+        record.points = int(data.get("points", 0))
+        record.total_points_earned = int(data.get("total_points_earned", 0))
+        record.redeem_count = int(data.get("redeem_count", 0))
+        record.points_seq = int(data.get("points_seq", 0))
+        record.flags = 0
+        for name, bit in _FLAG_FIELDS:
+            if data.get(name, name == "joined"):
+                record.flags |= bit
+        record.captcha_question = data.get("captcha_question") or ""
+        record.captcha_answer = data.get("captcha_answer")
+        record.inactive_since = data.get("inactive_since")
+        record.last_seen = data.get("last_seen")
+        extra = {k: v for k, v in data.items() if k not in _USER_RECORD_KEYS}
+        record.extra = extra or None
+        return record
+
+    def to_dict(self, referrals: list[int]) -> dict:
+        data = {
+            "id": self.id,
+            "username": self.username,
+            "full_name": self.full_name,
+            "referred_by": self.referred_by,
+            "pending_referrer_id": self.pending_referrer_id,
+            "referrals": referrals,
+            "points": self.points,
+            "total_points_earned": self.total_points_earned,
+            "redeem_count": self.redeem_count,
+        }
+        for name, bit in _FLAG_FIELDS:
+            data[name] = bool(self.flags & bit)
+        data["captcha_question"] = self.captcha_question
+        data["captcha_answer"] = self.captcha_answer
+        if self.points_seq:
+            data["points_seq"] = self.points_seq
+        if self.inactive_since is not None:
+            data["inactive_since"] = self.inactive_since
+        if self.last_seen is not None:
+            data["last_seen"] = self.last_seen
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+
+_USER_RECORD_KEYS = frozenset(
+    [slot for slot in UserRecord.__slots__ if slot not in ("flags", "extra")]
+    + [name for name, _ in _FLAG_FIELDS]
+    + ["referrals"]
+)
+
+
+def _new_user_record(user) -> UserRecord:
+    return UserRecord(user.id, user.username or "", user.full_name or "")
+
+
+# ================= ترقية بنية البيانات =================
+def _migrate_v1_backfill_defaults(users: dict[str, dict]):
+    for uid, user_data in users.items():
+        if "id" not in user_data:
+            user_data["id"] = int(uid)
+        if "username" not in user_data:
+            user_data["username"] = ""
+        if "full_name" not in user_data:
+            user_data["full_name"] = ""
+        if "referred_by" not in user_data:
+            user_data["referred_by"] = None
+        if "pending_referrer_id" not in user_data:
+            user_data["pending_referrer_id"] = None
+        if "referrals" not in user_data or not isinstance(user_data["referrals"], list):
+            user_data["referrals"] = []
+        if "points" not in user_data:
+            user_data["points"] = 0
+        if "total_points_earned" not in user_data:
+            user_data["total_points_earned"] = 0
+        if "redeem_count" not in user_data:
+            user_data["redeem_count"] = 0
+        if "joined" not in user_data:
+            user_data["joined"] = True
+        if "human_verified" not in user_data:
+            user_data["human_verified"] = False
+        if "referral_counted" not in user_data:
+            user_data["referral_counted"] = False
+        if "referral_reward_reverted" not in user_data:
+            user_data["referral_reward_reverted"] = False
+        if "captcha_question" not in user_data:
+            user_data["captcha_question"] = ""
+        if "captcha_answer" not in user_data:
+            user_data["captcha_answer"] = None
+
+
+def _migrate_v2_mark_existing_announced(users: dict[str, dict]):
+    # كل مستخدم محفوظ سبق أن دخل البوت وأُبلغ الأدمن عنه، فلا نعيد التنبيه بعد الترقية
+    for user_data in users.values():
+        user_data["announced"] = True
+
+
+# الترقية رقم i تنقل البيانات من النسخة i إلى i + 1
+USER_MIGRATIONS = [
+    _migrate_v1_backfill_defaults,
+    _migrate_v2_mark_existing_announced,
+]
+USER_SCHEMA_VERSION = len(USER_MIGRATIONS)
+
+
+class Leaderboard:
+    """
+    ترتيب المُحيلين محفوظ دائماً في قائمة مرتبة بمفاتيح (-العدد, ID)،
+    فتحديث عدد مُحيل واحد هو bisect + إدراج، وعرض أفضل K مجرد قراءة لأول K عنصر.
+    """
+
+    def __init__(self):
+        self._keys: list[tuple[int, int]] = []
+        self._count_of: dict[int, int] = {}
+
+    def update(self, user_id: int, count: int):
+        old = self._count_of.get(user_id)
+        if old == count:
+            return
+        if old is not None:
+            idx = bisect.bisect_left(self._keys, (-old, user_id))
+            del self._keys[idx]
+            del self._count_of[user_id]
+        if count > 0:
+            bisect.insort(self._keys, (-count, user_id))
+            self._count_of[user_id] = count
+
+    def __iter__(self):
+        for neg_count, user_id in self._keys:
+            yield user_id, -neg_count
+
+
+class ReferralGraph:
+    """
+    فهرس الإحالات: لكل مُحيل مجموعة المحالين (dict يُستخدم كمجموعة تحافظ على ترتيب الإضافة)،
+    وفهرس عكسي لمعرفة من أحال أي مستخدم. الفحص والإضافة والحذف كلها O(1).
+    التغييرات تُسجل لتكتبها طبقة التخزين كفروقات عند الـ flush.
+    """
+
+    def __init__(self):
+        self.children: dict[int, dict[int, None]] = {}
+        self.parent: dict[int, int] = {}
+        self.changes: list[tuple[bool, int, int, int]] = []
+        self.leaderboard = Leaderboard()
+
+    def load(self, referrer_id: int, user_ids):
+        kids = self.children.setdefault(int(referrer_id), {})
+        for uid in user_ids:
+            kids[int(uid)] = None
+            self.parent[int(uid)] = int(referrer_id)
+        self.leaderboard.update(int(referrer_id), len(kids))
+
+    def has(self, referrer_id: int, user_id: int) -> bool:
+        kids = self.children.get(int(referrer_id))
+        return bool(kids) and int(user_id) in kids
+
+    def add(self, referrer_id: int, user_id: int) -> bool:
+        referrer_id, user_id = int(referrer_id), int(user_id)
+        old_referrer = self.parent.get(user_id)
+        if old_referrer == referrer_id:
+            return False
+        if old_referrer is not None:
+            self.remove(old_referrer, user_id)
+
+        kids = self.children.setdefault(referrer_id, {})
+        kids[user_id] = None
+        self.parent[user_id] = referrer_id
+        self.changes.append((True, referrer_id, user_id, len(kids)))
+        self.leaderboard.update(referrer_id, len(kids))
+        return True
+
+    def remove(self, referrer_id: int, user_id: int) -> bool:
+        referrer_id, user_id = int(referrer_id), int(user_id)
+        kids = self.children.get(referrer_id)
+        if not kids or user_id not in kids:
+            return False
+
+        del kids[user_id]
+        self.leaderboard.update(referrer_id, len(kids))
+        if not kids:
+            del self.children[referrer_id]
+        if self.parent.get(user_id) == referrer_id:
+            del self.parent[user_id]
+        self.changes.append((False, referrer_id, user_id, 0))
+        return True
+
+    def count(self, referrer_id: int) -> int:
+        return len(self.children.get(int(referrer_id), ()))
+
+    def referrer_of(self, user_id: int) -> int | None:
+        return self.parent.get(int(user_id))
+
+    def children_of(self, referrer_id: int) -> list[int]:
+        return list(self.children.get(int(referrer_id), ()))
+
+    def drain_changes(self) -> list[tuple[bool, int, int, int]]:
+        changes, self.changes = self.changes, []
+        return changes
+
+
+_DAY = 86400
+
+
+class UserIndexes:
+    """
+    فهارس الفئات المستخدمة في الإذاعة الموجهة، تُحدَّث عند كل تعديل على السجل
+    حتى تكون كلفة استخراج فئة بحجم الفئة نفسها لا بحجم كل المستخدمين.
+    """
+
+    def __init__(self):
+        self.verified: set[int] = set()
+        self._points_keys: list[tuple[int, int]] = []  # (النقاط, ID) مرتبة تصاعدياً
+        self._points_of: dict[int, int] = {}
+        self._days: dict[int, set[int]] = {}  # اليوم -> من كان آخر ظهور لهم فيه
+        self._day_of: dict[int, int] = {}
+
+    def rebuild(self, records):
+        self.__init__()
+        keys = []
+        for record in records:
+            self._update_flags(record)
+            self._points_of[record.id] = record.points
+            keys.append((record.points, record.id))
+            self._update_day(record)
+        keys.sort()
+        self._points_keys = keys
+
+    def update(self, record: UserRecord):
+        self._update_flags(record)
+        self._update_points(record)
+        self._update_day(record)
+
+    def _update_flags(self, record: UserRecord):
+        if record.human_verified:
+            self.verified.add(record.id)
+        else:
+            self.verified.discard(record.id)
+
+    def _update_points(self, record: UserRecord):
+        old = self._points_of.get(record.id)
+        if old == record.points:
+            return
+        if old is not None:
+            del self._points_keys[bisect.bisect_left(self._points_keys, (old, record.id))]
+        bisect.insort(self._points_keys, (record.points, record.id))
+        self._points_of[record.id] = record.points
+
+    def _update_day(self, record: UserRecord):
+        if record.last_seen is None:
+            return
+        day = record.last_seen // _DAY
+        old = self._day_of.get(record.id)
+        if old == day:
+            return
+        if old is not None:
+            self._days[old].discard(record.id)
+            if not self._days[old]:
+                del self._days[old]
+        self._days.setdefault(day, set()).add(record.id)
+        self._day_of[record.id] = day
+
+    def points_at_least(self, threshold: int) -> list[int]:
+        start = bisect.bisect_left(self._points_keys, (threshold, -sys.maxsize))
+        return [user_id for _, user_id in self._points_keys[start:]]
+
+    def seen_within(self, days: int) -> list[int]:
+        first_day = int(time.time()) // _DAY - days + 1
+        result = []
+        for day, user_ids in self._days.items():
+            if day >= first_day:
+                result.extend(user_ids)
+        return result
+
+
+class UserStore:
+    """
+    نسخة المستخدمين في الذاكرة: تُقرأ مرة واحدة عند التشغيل،
+    والتعديلات تُعلَّم كـ dirty وتُكتب على القرص دفعة واحدة بشكل دوري وعند الإيقاف.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.users: dict[int, UserRecord] = {}
+        self.meta: dict = {}
+        self.dirty: set[int] = set()
+        self.referrals = ReferralGraph()
+        self.inactive: set[int] = set()
+        self.indexes = UserIndexes()
+        self.loaded = False
+
+    def load(self):
+        raw_users, self.meta = self.storage.load_users()
+        migrated = self._migrate(raw_users)
+        self.users = {}
+        self.referrals = ReferralGraph()
+        self.inactive = set()
+        for uid, data in raw_users.items():
+            record = self.users[int(uid)] = UserRecord.from_dict(data)
+            if record.inactive_since is not None:
+                self.inactive.add(record.id)
+            if data.get("referrals"):
+                self.referrals.load(int(uid), data["referrals"])
+        self.dirty.clear()
+        self.indexes.rebuild(self.users.values())
+        self.loaded = True
+        if migrated:
+            self.storage.write_users(self.storage.snapshot_users(self, set(self.users)))
+
+    def _migrate(self, raw_users: dict[str, dict]) -> bool:
+        version = int(self.meta.get("schema_version", 0))
+        if version >= USER_SCHEMA_VERSION:
+            return False
+
+        for migration in USER_MIGRATIONS[version:]:
+            migration(raw_users)
+        self.meta["schema_version"] = USER_SCHEMA_VERSION
+        logger.info("Migrated %s users from schema v%s to v%s", len(raw_users), version, USER_SCHEMA_VERSION)
+        return True
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def get(self, user_id) -> UserRecord | None:
+        self._ensure_loaded()
+        return self.users.get(int(user_id))
+
+    def add(self, record: UserRecord) -> UserRecord:
+        self._ensure_loaded()
+        self.users[record.id] = record
+        self.mark_dirty(record.id)
+        return record
+
+    def mark_dirty(self, user_id):
+        self.dirty.add(int(user_id))
+        record = self.users.get(int(user_id))
+        if record is not None:
+            self.indexes.update(record)
+
+    def touch(self, user_id: int):
+        record = self.get(user_id)
+        if record is None:
+            return
+        now = int(time.time())
+        if record.last_seen is None or record.last_seen // _DAY != now // _DAY:
+            record.last_seen = now
+            self.mark_dirty(record.id)
+
+    def ids(self) -> list[int]:
+        self._ensure_loaded()
+        return list(self.users)
+
+    def active_ids(self) -> list[int]:
+        self._ensure_loaded()
+        return [uid for uid in self.users if uid not in self.inactive]
+
+    def mark_inactive(self, user_id: int):
+        record = self.get(user_id)
+        if record is None or record.inactive_since is not None:
+            return
+        record.inactive_since = int(time.time())
+        self.inactive.add(record.id)
+        self.dirty.add(record.id)
+
+    def reactivate(self, user_id: int):
+        record = self.get(user_id)
+        if record is None or record.inactive_since is None:
+            return
+        record.inactive_since = None
+        self.inactive.discard(record.id)
+        self.dirty.add(record.id)
+
+    def records(self):
+        self._ensure_loaded()
+        return self.users.values()
+
+    def __contains__(self, user_id) -> bool:
+        self._ensure_loaded()
+        return int(user_id) in self.users
+
+    def __len__(self) -> int:
+        self._ensure_loaded()
+        return len(self.users)
+
+    def flush(self) -> tuple[set[int], concurrent.futures.Future] | None:
+        if not self.loaded or not (self.dirty or self.referrals.changes):
+            return None
+        dirty, self.dirty = self.dirty, set()
+        snapshot = self.storage.snapshot_users(self, dirty)
+        return dirty, WRITER.submit(self.storage.write_users, snapshot)
+
+    async def flush_async(self):
+        pending = self.flush()
+        if pending is None:
+            return
+        dirty, future = pending
+        try:
+            # shield: إلغاء الحلقة عند الإغلاق لا يلغي كتابة في الطابور
+            await asyncio.shield(asyncio.wrap_future(future))
+        except asyncio.CancelledError:
+            # قد لا تكون الكتابة انتهت؛ يعيد flush الأخير كتابة هذه الصفوف
+            self.dirty |= dirty
+            raise
+        except Exception:
+            # نعيدها للدفعة القادمة؛ الخطأ نفسه سُجل في خيط الكتابة
+            self.dirty |= dirty
+
+
+USER_STORE = UserStore(STORAGE)
+
+
+async def _users_flush_loop():
+    while True:
+        await asyncio.sleep(USERS_FLUSH_INTERVAL)
+        await USER_STORE.flush_async()
+
+
+# ================= سجل النقاط =================
+POINTS_LEDGER_FILE = DATA_DIR / "points_ledger.jsonl"
+POINTS_SNAPSHOT_FILE = DATA_DIR / "points_snapshot.json"
+POINTS_LEDGER_FSYNC_INTERVAL = float(os.getenv("POINTS_LEDGER_FSYNC_INTERVAL", "1"))  # بالثواني
+POINTS_LEDGER_COMPACT_EVERY = int(os.getenv("POINTS_LEDGER_COMPACT_EVERY", "5000"))  # عدد القيود
+
+
+class PointsLedger:
+    """
+    كل تغيير في الرصيد يُضاف كسطر في ملف append-only، والأرصدة نفسها تعيش في الذاكرة.
+    الـ fsync يتم على دفعات، وبعد عدد معين من القيود تُكتب لقطة (snapshot) ويُفرَّغ السجل.
+    عند التشغيل: نطبّق اللقطة ثم نعيد تشغيل ما بعدها من السجل.
+    بعد الفتح كل عمليات الملف تمر عبر WRITER، فالإضافة والتفريغ لا يتداخلان.
+    """
+
+    def __init__(self, path: Path, snapshot_path: Path, store: UserStore):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.store = store
+        self.seq = 0
+        self.entries_since_snapshot = 0
+        self.unsynced = 0
+        self._file = None
+
+    def open(self):
+        if self._file is not None:
+            return
+
+        snapshot = _read_json(self.snapshot_path, None)
+        if not isinstance(snapshot, dict) or not isinstance(snapshot.get("balances"), dict):
+            # أول تشغيل للسجل: أرصدة ملف المستخدمين هي نقطة البداية، وأي قيود موجودة
+            # (لقطة ضائعة أو تالفة) تُطبق عليها قبل أن تُفرّغها اللقطة الجديدة
+            # لا نعيد استخدام أرقام قيود سبق أن دخلت في أرصدة المستخدمين
+            self.seq = max((record.points_seq for record in self.store.records()), default=0)
+            replayed = self._replay(0, skip_applied=True)
+            if replayed:
+                logger.warning("Points snapshot missing; replayed %s ledger entries onto stored balances", replayed)
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._write_snapshot(self.seq, self._balances())
+            self.store.indexes.rebuild(self.store.records())
+            return
+
+        snapshot_seq = int(snapshot.get("seq", 0))
+        balances = snapshot["balances"]
+        for record in self.store.records():
+            points, earned = balances.get(str(record.id), (0, 0))
+            if record.points != int(points) or record.total_points_earned != int(earned):
+                record.points = int(points)
+                record.total_points_earned = int(earned)
+                self.store.mark_dirty(record.id)
+
+        self.seq = snapshot_seq
+        replayed = self._replay(snapshot_seq)
+        self.entries_since_snapshot = replayed
+        self._file = open(self.path, "a", encoding="utf-8")
+        self.store.indexes.rebuild(self.store.records())
+        if replayed:
+            logger.info("Replayed %s points ledger entries after seq %s", replayed, snapshot_seq)
+
+    def _replay(self, after_seq: int, skip_applied: bool = False) -> int:
+        # skip_applied: الأرصدة من ملف المستخدمين لا من اللقطة، فما سبق points_seq محسوب فيها
+        replayed = 0
+        if not self.path.exists():
+            return replayed
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # سطر ناقص من آخر كتابة قبل الانهيار
+                seq = int(entry.get("seq", 0))
+                if seq <= after_seq:
+                    continue
+                record = self.store.get(entry.get("uid", 0))
+                if skip_applied and record is not None and seq <= record.points_seq:
+                    continue
+                if record is not None:
+                    self._apply(record, int(entry.get("delta", 0)), int(entry.get("earned", 0)), seq)
+                    self.store.mark_dirty(record.id)
+                self.seq = max(self.seq, seq)
+                replayed += 1
+        return replayed
+
+    @staticmethod
+    def _apply(record: UserRecord, delta: int, earned: int, seq: int):
+        record.points_seq = seq
+        record.points += delta
+        if earned:
+            record.total_points_earned += earned
+
+    def record(self, user_id, delta: int, reason: str, earned: int = 0) -> bool:
+        self.open()
+        record = self.store.get(user_id)
+        if record is None:
+            return False
+
+        self.seq += 1
+        entry = {
+            "seq": self.seq,
+            "uid": int(user_id),
+            "delta": int(delta),
+            "earned": int(earned),
+            "reason": reason,
+            "ts": int(time.time()),
+        }
+        WRITER.submit(self._append, json.dumps(entry, ensure_ascii=False) + "\n")
+        self.unsynced += 1
+        self.entries_since_snapshot += 1
+
+        self._apply(record, int(delta), int(earned), self.seq)
+        # ملف المستخدمين يبقى نسخة صحيحة للأرصدة لو ضاعت اللقطة
+        self.store.mark_dirty(record.id)
+        return True
+
+    # ----- تُنفذ في خيط الكتابة -----
+    def _append(self, line: str):
+        self._file.write(line)
+        self._file.flush()
+
+    def _fsync(self):
+        os.fsync(self._file.fileno())
+
+    def _write_snapshot(self, seq: int, balances: dict):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        _write_json(self.snapshot_path, {"seq": seq, "balances": balances})
+
+        # اللقطة صارت على القرص، فكل القيود حتى seq لم تعد لازمة
+        self._file.close()
+        self._file = open(self.path, "w", encoding="utf-8")
+
+    def _close_file(self):
+        self._file.close()
+        self._file = None
+
+    # ----- تُستدعى من خيط الـ loop -----
+    def _balances(self) -> dict:
+        balances = {}
+        for record in self.store.records():
+            if record.points or record.total_points_earned:
+                balances[str(record.id)] = [record.points, record.total_points_earned]
+        return balances
+
+    def sync(self):
+        if self._file is None or not self.unsynced:
+            return
+        self.unsynced = 0
+        WRITER.submit(self._fsync)
+
+    def compact(self):
+        if self._file is None or not self.entries_since_snapshot:
+            return
+        # الأرصدة و seq يُلتقطان معاً على خيط الـ loop فيبقيان متطابقين
+        WRITER.submit(self._write_snapshot, self.seq, self._balances())
+        self.unsynced = 0
+        self.entries_since_snapshot = 0
+
+    def close(self):
+        if self._file is None:
+            return
+        self.compact()
+        self.sync()
+        WRITER.submit(self._close_file)
+
+
+POINTS_LEDGER = PointsLedger(POINTS_LEDGER_FILE, POINTS_SNAPSHOT_FILE, USER_STORE)
+
+
+def add_points(user_id, delta: int, reason: str, earned: int = 0) -> bool:
+    return POINTS_LEDGER.record(user_id, delta, reason, earned)
+
+
+async def _points_ledger_loop():
+    while True:
+        await asyncio.sleep(POINTS_LEDGER_FSYNC_INTERVAL)
+        try:
+            POINTS_LEDGER.sync()
+            if POINTS_LEDGER.entries_since_snapshot >= POINTS_LEDGER_COMPACT_EVERY:
+                POINTS_LEDGER.compact()
+        except Exception:
+            logger.exception("Failed to sync points ledger")
+
+
+# ================= الإعدادات =================
+CONFIG_RECHECK_INTERVAL = float(os.getenv("CONFIG_RECHECK_INTERVAL", "2"))  # بالثواني
+
+
+def _apply_config_defaults(data: dict) -> dict:
     if "referral_points_per_invite" not in data:
         data["referral_points_per_invite"] = 1
-    if "blocked_users" not in data or not isinstance(data["blocked_users"], list):
-        data["blocked_users"] = []
     if "forced_sub_channel" not in data:
         data["forced_sub_channel"] = ""
     if "forced_sub_link" not in data:
@@ -136,30 +1385,1126 @@ def load_config() -> dict:
     return data
 
 
+class ConfigCache:
+    """
+    نسخة واحدة من الإعدادات في الذاكرة. لوحة الأدمن تعدّلها في مكانها،
+    وأي تعديل خارجي على التخزين يُكتشف عبر config_version() مرة كل CONFIG_RECHECK_INTERVAL.
+    الفحص يُؤجل ما دامت هناك كتابات في الطابور، حتى لا نقرأ نسخة أقدم من التي في الذاكرة.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.data: dict | None = None
+        self.version = None
+        self.checked_at = 0.0
+
+    def _reload(self):
+        self.version = self.storage.config_version()
+        data = _apply_config_defaults(self.storage.load_config())
+        if self.data is None:
+            self.data = data
+        else:
+            self.data.clear()
+            self.data.update(data)
+
+    def get(self) -> dict:
+        now = time.monotonic()
+        if self.data is None:
+            self._reload()
+            self.checked_at = now
+        elif now - self.checked_at >= CONFIG_RECHECK_INTERVAL and WRITER.idle():
+            self.checked_at = now
+            if self.storage.config_version() != self.version:
+                self._reload()
+        return self.data
+
+    def _write(self, data: dict):
+        self.storage.save_config(data)
+        self.version = self.storage.config_version()
+
+    def save(self, data: dict):
+        if self.data is None:
+            self.data = data
+        elif data is not self.data:
+            self.data.clear()
+            self.data.update(data)
+        WRITER.submit(self._write, dict(self.data))
+
+
+CONFIG_CACHE = ConfigCache(STORAGE)
+
+
+def load_config() -> dict:
+    return CONFIG_CACHE.get()
+
+
 def save_config(data: dict):
-    _write_json(CONFIG_FILE, data)
+    CONFIG_CACHE.save(data)
+
+
+# ================= قائمة الحظر =================
+class Blocklist:
+    """مجموعة hash في الذاكرة، والتخزين يستقبل الإضافات والحذف بشكل تزايدي فقط."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.ids: set[int] | None = None
+
+    def load(self):
+        self.ids = self.storage.load_blocked()
+
+        # النسخ القديمة كانت تحفظ القائمة داخل config.json
+        config = load_config()
+        legacy = config.pop("blocked_users", None)
+        if legacy is not None:
+            if isinstance(legacy, list):
+                self.add_many(legacy)
+            save_config(config)
+
+    def _ensure_loaded(self) -> set[int]:
+        if self.ids is None:
+            self.load()
+        return self.ids
+
+    def __contains__(self, user_id) -> bool:
+        return int(user_id) in self._ensure_loaded()
+
+    def __len__(self) -> int:
+        return len(self._ensure_loaded())
+
+    def add(self, user_id) -> bool:
+        return self.add_many([user_id]) == 1
+
+    def add_many(self, user_ids) -> int:
+        ids = self._ensure_loaded()
+        new_ids = []
+        for uid in user_ids:
+            uid = int(uid)
+            if uid not in ids:
+                ids.add(uid)
+                new_ids.append(uid)
+        if new_ids:
+            WRITER.submit(self.storage.add_blocked, new_ids)
+        return len(new_ids)
+
+    def remove(self, user_id) -> bool:
+        ids = self._ensure_loaded()
+        uid = int(user_id)
+        if uid not in ids:
+            return False
+        ids.discard(uid)
+        WRITER.submit(self.storage.remove_blocked, [uid])
+        return True
+
+
+BLOCKLIST = Blocklist(STORAGE)
+
+
+# ================= السلع وطلبات الاستبدال =================
+class RewardsCatalog:
+    def __init__(self, storage):
+        self.storage = storage
+        self.items: list[dict] | None = None
+
+    def load(self):
+        self.items = self.storage.list_rewards()
+
+    def all(self) -> list[dict]:
+        if self.items is None:
+            self.load()
+        return self.items
+
+    def get(self, reward_id: int) -> dict | None:
+        for item in self.all():
+            if int(item.get("id", 0)) == int(reward_id):
+                return item
+        return None
+
+    def next_id(self) -> int:
+        items = self.all()
+        if not items:
+            return 1
+        return max(int(item.get("id", 0)) for item in items) + 1
+
+    def add(self, name: str, cost: int) -> dict:
+        item = {"id": self.next_id(), "name": name, "cost": cost}
+        self.all().append(item)
+        WRITER.submit(self.storage.add_reward, dict(item))
+        return item
+
+    def update(self, reward_id: int, field: str, value) -> bool:
+        item = self.get(reward_id)
+        if item is None:
+            return False
+        item[field] = value
+        WRITER.submit(self.storage.update_reward, int(reward_id), field, value)
+        return True
+
+    def delete(self, reward_id: int) -> bool:
+        item = self.get(reward_id)
+        if item is None:
+            return False
+        self.items.remove(item)
+        WRITER.submit(self.storage.delete_reward, int(reward_id))
+        return True
+
+
+class PendingRedeems:
+    def __init__(self, storage):
+        self.storage = storage
+        self.requests: dict[int, dict] | None = None
+
+    def load(self):
+        self.requests = {int(uid): req for uid, req in self.storage.load_pending_redeems().items()}
+
+    def _all(self) -> dict[int, dict]:
+        if self.requests is None:
+            self.load()
+        return self.requests
+
+    def get(self, user_id: int) -> dict | None:
+        return self._all().get(int(user_id))
+
+    def put(self, request: dict):
+        self._all()[int(request["user_id"])] = request
+        WRITER.submit(self.storage.put_pending_redeem, dict(request))
+
+    def set_status(self, user_id: int, status: str):
+        req = self.get(user_id)
+        if req:
+            req["status"] = status
+            WRITER.submit(self.storage.set_pending_redeem_status, int(user_id), status)
+
+    def ids(self):
+        return self._all().keys()
+
+    def remove(self, user_id: int):
+        if self._all().pop(int(user_id), None) is not None:
+            WRITER.submit(self.storage.remove_pending_redeem, int(user_id))
+
+
+REWARDS = RewardsCatalog(STORAGE)
+PENDING_REDEEMS = PendingRedeems(STORAGE)
+
+
+def load_storage():
+    USER_STORE.load()
+    POINTS_LEDGER.open()
+    CONFIG_CACHE.get()
+    BLOCKLIST.load()
+    REWARDS.load()
+    PENDING_REDEEMS.load()
+    BROADCASTS.load()
+    SCHEDULER.load()
+    UPDATE_OFFSET.load()
+    NOTIFY_QUEUE.load()
 
 
 def load_rewards() -> dict:
-    data = _read_json(REWARDS_FILE, {"items": []})
-    if "items" not in data or not isinstance(data["items"], list):
-        data["items"] = []
-    return data
+    return {"items": REWARDS.all()}
 
 
-def save_rewards(data: dict):
-    _write_json(REWARDS_FILE, data)
+# ================= كاش الاشتراك الإجباري =================
+MEMBERSHIP_CACHE_TTL = float(os.getenv("MEMBERSHIP_CACHE_TTL", "300"))  # بالثواني، للمشترك
+MEMBERSHIP_CACHE_NEGATIVE_TTL = float(os.getenv("MEMBERSHIP_CACHE_NEGATIVE_TTL", "20"))  # لغير المشترك
+MEMBERSHIP_CACHE_MAX_ENTRIES = int(os.getenv("MEMBERSHIP_CACHE_MAX_ENTRIES", "100000"))
 
 
-def load_pending_redeems() -> dict:
-    data = _read_json(PENDING_REDEEMS_FILE, {"requests": {}})
-    if "requests" not in data or not isinstance(data["requests"], dict):
-        data["requests"] = {}
-    return data
+class MembershipCache:
+    """
+    نتيجة get_chat_member لكل (قناة، مستخدم) مع مدة صلاحية.
+    غير المشترك يُحفظ لمدة أقصر حتى يُلاحظ اشتراكه بسرعة.
+    تغيير القناة يمسح الكاش كاملاً.
+    """
+
+    def __init__(self):
+        self.channel = ""
+        self.entries: dict[tuple[str, int], tuple[bool, float]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, channel: str, user_id: int) -> bool | None:
+        if channel != self.channel:
+            self.clear()
+            self.channel = channel
+        entry = self.entries.get((channel, user_id))
+        if entry is None or entry[1] <= time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def put(self, channel: str, user_id: int, subscribed: bool):
+        if channel != self.channel:
+            return
+        now = time.monotonic()
+        if len(self.entries) >= MEMBERSHIP_CACHE_MAX_ENTRIES:
+            self.entries = {key: entry for key, entry in self.entries.items() if entry[1] > now}
+            if len(self.entries) >= MEMBERSHIP_CACHE_MAX_ENTRIES:
+                self.entries.clear()
+        ttl = MEMBERSHIP_CACHE_TTL if subscribed else MEMBERSHIP_CACHE_NEGATIVE_TTL
+        self.entries[(channel, user_id)] = (subscribed, now + ttl)
+
+    def invalidate(self, user_id: int):
+        self.entries.pop((self.channel, user_id), None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+MEMBERSHIP_CACHE = MembershipCache()
+
+SUBSCRIBED_STATUSES = ("member", "administrator", "creator", "restricted")
+
+
+class ChannelMembers:
+    """
+    جدول محلي لعضوية قناة الاشتراك الإجباري يُبنى من تحديثات chat_member.
+    وصول أول تحديث من القناة يعني أن البوت أدمن فيها ويستقبل كل التغييرات،
+    فيصبح الجدول مرجعاً: نتيجة أي فحص عبر API تُضاف إليه، وما يلحقها يصل كتحديث.
+    """
+
+    def __init__(self):
+        self.channel = ""
+        self.members: dict[int, bool] = {}
+        self.active = False
+
+    def _sync_channel(self, channel: str):
+        if channel != self.channel:
+            self.channel = channel
+            self.members.clear()
+            self.active = False
+
+    @staticmethod
+    def matches(channel: str, chat) -> bool:
+        if str(chat.id) == channel:
+            return True
+        username = getattr(chat, "username", None)
+        return bool(username) and f"@{username}".lower() == channel.lower()
+
+    def lookup(self, channel: str, user_id: int) -> bool | None:
+        self._sync_channel(channel)
+        if not self.active:
+            return None
+        return self.members.get(user_id)
+
+    def record(self, channel: str, user_id: int, subscribed: bool):
+        self._sync_channel(channel)
+        if self.active:
+            self.members[user_id] = subscribed
+
+    def on_event(self, channel: str, user_id: int, subscribed: bool):
+        self._sync_channel(channel)
+        self.active = True
+        self.members[user_id] = subscribed
+
+
+CHANNEL_MEMBERS = ChannelMembers()
+
+
+# ================= محرك الإذاعة =================
+# حصة الإذاعة من SEND_RATE؛ الباقي يبقى متاحاً لردود المستخدمين أثناء الإذاعة
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))  # رسالة/ثانية
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))  # بالثواني
+
+
+class TokenBucket:
+    """
+    محدد معدل عام: رمز لكل رسالة، يمتلئ بمعدل rate في الثانية.
+    عند RetryAfter يتوقف الإرسال كله حتى تنتهي المهلة، لأن حد Telegram على البوت كاملاً.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block_for(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def idle(self) -> bool:
+        # ممتلئ ولا أحد ينتظره: حذفه لا يغير شيئاً
+        if self._lock.locked() or time.monotonic() < self.blocked_until:
+            return False
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+BROADCAST_LIMITER = TokenBucket(BROADCAST_RATE)
+
+
+SEND_SENT = "sent"
+SEND_FAILED = "failed"
+SEND_UNREACHABLE = "unreachable"  # حظر البوت أو حذف حسابه: لا فائدة من المحاولة مجدداً
+
+_UNREACHABLE_ERRORS = ("chat not found", "user is deactivated", "peer_id_invalid", "bot was blocked")
+
+
+def classify_send_error(error: TelegramError) -> str:
+    if isinstance(error, Forbidden):
+        return SEND_UNREACHABLE
+    if isinstance(error, BadRequest) and any(text in error.message.lower() for text in _UNREACHABLE_ERRORS):
+        return SEND_UNREACHABLE
+    return SEND_FAILED
+
+
+# الفئات التي تحتاج رقماً من الأدمن (حد النقاط / عدد الأيام) تأخذه في value
+BROADCAST_SEGMENTS = {
+    "all": "👥 الكل",
+    "verified": "✅ من اجتازوا التحقق",
+    "referrers": "🔗 المُحيلون النشطون",
+    "pending_redeem": "⏳ لديهم طلب استبدال",
+    "points": "💰 نقاطهم لا تقل عن حد",
+    "active_days": "📅 نشطون خلال آخر أيام",
+}
+_SEGMENTS_WITH_VALUE = ("points", "active_days")
+
+
+_MEDIA_LABELS = {"photo": "صورة", "video": "فيديو", "document": "ملف"}
+
+
+def resolve_segment(segment: dict) -> list[int]:
+    kind = segment.get("kind", "all")
+    value = int(segment.get("value") or 0)
+    if kind == "verified":
+        user_ids = USER_STORE.indexes.verified
+    elif kind == "referrers":
+        user_ids = USER_STORE.referrals.children.keys()
+    elif kind == "pending_redeem":
+        user_ids = PENDING_REDEEMS.ids()
+    elif kind == "points":
+        user_ids = USER_STORE.indexes.points_at_least(value)
+    elif kind == "active_days":
+        user_ids = USER_STORE.indexes.seen_within(value)
+    else:
+        return USER_STORE.active_ids()
+    inactive = USER_STORE.inactive
+    return [uid for uid in user_ids if uid not in inactive and uid in USER_STORE]
+
+
+def segment_label(segment: dict) -> str:
+    label = BROADCAST_SEGMENTS.get(segment.get("kind", "all"), BROADCAST_SEGMENTS["all"])
+    if segment.get("kind") in _SEGMENTS_WITH_VALUE:
+        label += f" ({segment.get('value')})"
+    return label
+
+
+class Broadcast:
+    """
+    مهمة إذاعة قابلة للاستئناف. المستهدفون مرتبون تصاعدياً، و cursor هو أصغر id
+    لم يكتمل إرساله بعد: كل ما قبله تم، فعند الاستئناف نبدأ منه.
+    الإرسالات التي كانت جارية لحظة الانقطاع قد تتكرر (بحد أقصى BROADCAST_CONCURRENCY).
+    """
+
+    def __init__(
+        self, job_id: str, text: str, user_ids: list[int], segment: dict | None = None, media: dict | None = None
+    ):
+        self.id = job_id
+        self.text = text
+        self.media = media  # {"type": photo|video|document, "file_id": ...} والنص يصبح تعليقاً عليها
+        self.segment = segment or {"kind": "all"}
+        self.user_ids = user_ids
+        self.total = len(user_ids)
+        self.sent = 0
+        self.failed = 0
+        self.failed_ids: list[int] = []
+        self.unreachable = 0
+        self.status = "running"  # running | paused | cancelled | done
+        self.chat_id: int | None = None
+        self.message_id: int | None = None
+        self._next = 0
+        self._in_flight: set[int] = set()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "cancelled")
+
+    def cursor(self) -> int | None:
+        index = min(self._in_flight) if self._in_flight else self._next
+        return self.user_ids[index] if index < len(self.user_ids) else None
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "text": self.text,
+            "media": self.media,
+            "segment": self.segment,
+            "status": self.status,
+            "cursor": self.cursor(),
+            "total": self.total,
+            "sent": self.sent,
+            "failed": self.failed,
+            "failed_ids": self.failed_ids,
+            "unreachable": self.unreachable,
+            "chat_id": self.chat_id,
+            "message_id": self.message_id,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Broadcast":
+        segment = data.get("segment") or {"kind": "all"}
+        cursor = data.get("cursor")
+        remaining = [] if cursor is None else sorted(uid for uid in resolve_segment(segment) if uid >= int(cursor))
+        job = cls(str(data["id"]), data.get("text", ""), remaining, segment, data.get("media"))
+        job.sent = int(data.get("sent", 0))
+        job.failed = int(data.get("failed", 0))
+        job.failed_ids = [int(uid) for uid in data.get("failed_ids", [])]
+        job.unreachable = int(data.get("unreachable", 0))
+        job.total = job.sent + job.failed + job.unreachable + len(remaining)
+        job.status = data.get("status", "paused")
+        job.chat_id = data.get("chat_id")
+        job.message_id = data.get("message_id")
+        return job
+
+    async def _send(self, bot, user_id: int) -> str:
+        # الإذاعة تأخذ من حصتها أولاً، ثم حد المعدل العام وإعادة المحاولة يتولاهما SEND_GUARD
+        await BROADCAST_LIMITER.acquire()
+        try:
+            await self._deliver(bot, user_id)
+            return SEND_SENT
+        except TelegramError as e:
+            return classify_send_error(e)
+
+    async def _deliver(self, bot, user_id: int):
+        if self.media is None:
+            await bot.send_message(chat_id=user_id, text=self.text)
+            return
+        kind = self.media["type"]
+        send = getattr(bot, f"send_{kind}")
+        await send(chat_id=user_id, caption=self.text or None, **{kind: self.media["file_id"]})
+
+    async def _worker(self, bot):
+        while self.status == "running" and self._next < len(self.user_ids):
+            index = self._next
+            self._next += 1
+            self._in_flight.add(index)
+            user_id = self.user_ids[index]
+            result = await self._send(bot, user_id)
+            self._in_flight.discard(index)
+            if result == SEND_SENT:
+                self.sent += 1
+            elif result == SEND_UNREACHABLE:
+                self.unreachable += 1
+                USER_STORE.mark_inactive(user_id)
+            else:
+                self.failed += 1
+                self.failed_ids.append(user_id)
+
+    async def run(self, bot, on_progress):
+        workers = [asyncio.create_task(self._worker(bot)) for _ in range(BROADCAST_CONCURRENCY)]
+        try:
+            while not all(worker.done() for worker in workers):
+                await asyncio.wait(workers, timeout=BROADCAST_PROGRESS_INTERVAL)
+                await on_progress(self)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        if self.status == "running" and self._next >= len(self.user_ids):
+            self.status = "done"
+        await on_progress(self)
+
+    def status_text(self) -> str:
+        titles = {
+            "running": "📢 جاري الإذاعة...",
+            "paused": "⏸ الإذاعة متوقفة مؤقتاً",
+            "cancelled": "✖️ تم إلغاء الإذاعة",
+            "done": "📢 انتهت الإذاعة",
+        }
+        lines = [
+            f"🎯 الفئة: {segment_label(self.segment)}",
+        ]
+        if self.media:
+            lines.append(f"🖼 وسائط: {_MEDIA_LABELS.get(self.media['type'], self.media['type'])}")
+        lines += [
+            f"✅ تم الإرسال إلى: {self.sent}",
+            f"❌ فشل الإرسال إلى: {self.failed}",
+            f"🚫 غير متاحين (حظروا البوت أو حذفوا الحساب): {self.unreachable}",
+        ]
+        if not self.finished:
+            lines.append(f"⏳ المتبقي: {self.total - self.sent - self.failed - self.unreachable}")
+        return titles[self.status] + "\n\n" + "\n".join(lines)
+
+    def controls(self) -> InlineKeyboardMarkup:
+        if self.finished:
+            return admin_menu()
+        toggle = (
+            InlineKeyboardButton("⏸ إيقاف مؤقت", callback_data=f"bc_pause:{self.id}")
+            if self.status == "running"
+            else InlineKeyboardButton("▶️ استئناف", callback_data=f"bc_resume:{self.id}")
+        )
+        return InlineKeyboardMarkup([[toggle, InlineKeyboardButton("✖️ إلغاء", callback_data=f"bc_cancel:{self.id}")]])
+
 
+def _unique_id(taken) -> str:
+    # معرف بالمللي ثانية؛ عند تزامن إنشاء عنصرين نزيد حتى لا يطغى أحدهما على الآخر
+    candidate = int(time.time() * 1000)
+    while str(candidate) in taken:
+        candidate += 1
+    return str(candidate)
 
-def save_pending_redeems(data: dict):
-    _write_json(PENDING_REDEEMS_FILE, data)
+
+class BroadcastManager:
+    """
+    الإذاعات تعمل كمهام خلفية وحالتها محفوظة في BROADCASTS_FILE،
+    فبعد إعادة التشغيل تُستأنف الجارية منها من آخر cursor.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.jobs: dict[str, Broadcast] = {}
+        self.tasks: dict[str, asyncio.Task] = {}
+
+    def load(self):
+        data = _read_json(self.path, {"jobs": []})
+        for item in data.get("jobs", []):
+            job = Broadcast.from_dict(item)
+            if not job.finished:
+                self.jobs[job.id] = job
+
+    def save(self):
+        snapshot = {"jobs": [job.to_dict() for job in self.jobs.values()]}
+        WRITER.submit(_write_json, self.path, snapshot)
+
+    def create(self, text: str, segment: dict, media: dict | None = None) -> Broadcast:
+        job_id = _unique_id(self.jobs)
+        job = Broadcast(job_id, text, sorted(resolve_segment(segment)), segment, media)
+        self.jobs[job_id] = job
+        return job
+
+    def start(self, bot, job: Broadcast):
+        job.status = "running"
+        self.save()
+        self.tasks[job.id] = asyncio.create_task(self._run(bot, job))
+
+    async def _run(self, bot, job: Broadcast):
+        last_text = ""
+
+        async def on_progress(b: Broadcast):
+            nonlocal last_text
+            if b.finished:
+                self.jobs.pop(b.id, None)
+            self.save()
+            text = b.status_text()
+            if text == last_text or b.chat_id is None:
+                return
+            last_text = text
+            try:
+                await bot.edit_message_text(
+                    text, chat_id=b.chat_id, message_id=b.message_id, reply_markup=b.controls()
+                )
+            except TelegramError:
+                pass
+
+        try:
+            await job.run(bot, on_progress)
+        except Exception:
+            logger.exception("Broadcast %s failed", job.id)
+        finally:
+            self.tasks.pop(job.id, None)
+
+    def pause(self, job_id: str) -> Broadcast | None:
+        job = self.jobs.get(job_id)
+        if job and job.status == "running":
+            job.status = "paused"
+        return job
+
+    def resume(self, bot, job_id: str) -> Broadcast | None:
+        job = self.jobs.get(job_id)
+        if job and job.status == "paused" and job_id not in self.tasks:
+            self.start(bot, job)
+        return job
+
+    def cancel(self, job_id: str) -> Broadcast | None:
+        job = self.jobs.get(job_id)
+        if job:
+            job.status = "cancelled"
+            if job_id not in self.tasks:
+                self.jobs.pop(job_id, None)
+                self.save()
+        return job
+
+    def resume_all(self, bot):
+        for job in list(self.jobs.values()):
+            if job.status == "running":
+                self.start(bot, job)
+
+    async def stop(self):
+        # الإذاعات الجارية تبقى "running" في الملف لتُستأنف بعد التشغيل القادم
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.save()
+
+
+BROADCASTS = BroadcastManager(BROADCASTS_FILE)
+
+
+# ================= الإذاعات المجدولة =================
+SCHEDULE_TZ = timezone(timedelta(hours=float(os.getenv("SCHEDULE_UTC_OFFSET", "0"))))
+
+
+class BroadcastScheduler:
+    """
+    إذاعات مؤجلة أو متكررة تُنفذ عبر JobQueue. الجداول محفوظة في SCHEDULES_FILE،
+    وعند التشغيل يُعاد تسجيلها: ما فات موعده من الإذاعات لمرة واحدة يُرسل فوراً،
+    والمتكررة تُكمل من أقرب موعد قادم.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.schedules: dict[str, dict] = {}
+        self.job_queue = None
+
+    def load(self):
+        data = _read_json(self.path, {"schedules": []})
+        self.schedules = {str(item["id"]): item for item in data.get("schedules", [])}
+
+    def save(self):
+        snapshot = {"schedules": [dict(item) for item in self.schedules.values()]}
+        WRITER.submit(_write_json, self.path, snapshot)
+
+    def install(self, job_queue):
+        if job_queue is None:
+            if self.schedules:
+                logger.warning("JobQueue is not available; %s scheduled broadcasts will not run", len(self.schedules))
+            return
+        self.job_queue = job_queue
+        for schedule in self.schedules.values():
+            self._register(schedule)
+
+    @staticmethod
+    def _next_run(schedule: dict) -> float:
+        run_at = float(schedule["run_at"])
+        interval = int(schedule.get("interval") or 0)
+        now = time.time()
+        if interval and run_at < now:
+            run_at += ((now - run_at) // interval + 1) * interval
+        return run_at
+
+    def _register(self, schedule: dict):
+        if self.job_queue is None:
+            return
+        when = max(0.0, self._next_run(schedule) - time.time())
+        self.job_queue.run_once(self._fire, when=when, data=schedule["id"], name=f"broadcast:{schedule['id']}")
+
+    def add(self, text: str, media: dict | None, segment: dict, run_at: float, interval: int) -> dict:
+        schedule = {
+            "id": _unique_id(self.schedules),
+            "text": text,
+            "media": media,
+            "segment": segment,
+            "run_at": run_at,
+            "interval": interval,
+        }
+        self.schedules[schedule["id"]] = schedule
+        self.save()
+        self._register(schedule)
+        return schedule
+
+    def remove(self, schedule_id: str) -> bool:
+        if self.schedules.pop(schedule_id, None) is None:
+            return False
+        if self.job_queue is not None:
+            for job in self.job_queue.get_jobs_by_name(f"broadcast:{schedule_id}"):
+                job.schedule_removal()
+        self.save()
+        return True
+
+    async def _fire(self, context: ContextTypes.DEFAULT_TYPE):
+        schedule = self.schedules.get(context.job.data)
+        if schedule is None:
+            return
+
+        job = BROADCASTS.create(schedule["text"], schedule["segment"], schedule.get("media"))
+        admin_id = _get_admin_id()
+        if admin_id:
+            try:
+                status_message = await context.bot.send_message(
+                    chat_id=admin_id, text=job.status_text(), reply_markup=job.controls()
+                )
+                job.chat_id = status_message.chat_id
+                job.message_id = status_message.message_id
+            except TelegramError:
+                pass
+        BROADCASTS.start(context.bot, job)
+
+        if schedule.get("interval"):
+            schedule["run_at"] = self._next_run(schedule)
+            self._register(schedule)
+        else:
+            self.schedules.pop(schedule["id"], None)
+        self.save()
+
+
+SCHEDULER = BroadcastScheduler(SCHEDULES_FILE)
+
+
+def parse_schedule_time(text: str) -> tuple[float, int]:
+    """
+    "YYYY-MM-DD HH:MM" أو "HH:MM" (أقرب موعد قادم)، ويمكن إضافة رقم في النهاية
+    للتكرار كل N ساعة.
+    """
+    t = (text or "").strip().translate(_ARABIC_DIGITS).translate(_EASTERN_ARABIC_DIGITS)
+    m = re.fullmatch(r"(?:(\d{4})-(\d{1,2})-(\d{1,2})\s+)?(\d{1,2}):(\d{2})(?:\s+(\d+))?", t)
+    if not m:
+        raise ValueError("Invalid schedule time")
+    year, month, day, hour, minute, hours = m.groups()
+    now = datetime.now(SCHEDULE_TZ)
+    if year:
+        run_at = datetime(int(year), int(month), int(day), int(hour), int(minute), tzinfo=SCHEDULE_TZ)
+    else:
+        run_at = now.replace(hour=int(hour), minute=int(minute), second=0, microsecond=0)
+        if run_at <= now:
+            run_at += timedelta(days=1)
+    interval = int(hours or 0) * 3600
+    if run_at <= now and not interval:
+        raise ValueError("Schedule time is in the past")
+    return run_at.timestamp(), interval
+
+
+def format_schedule(schedule: dict) -> str:
+    run_at = datetime.fromtimestamp(BroadcastScheduler._next_run(schedule), SCHEDULE_TZ)
+    text = f"🕒 {run_at:%Y-%m-%d %H:%M}"
+    if schedule.get("interval"):
+        text += f" (كل {int(schedule['interval']) // 3600} ساعة)"
+    text += f"\n🎯 {segment_label(schedule['segment'])}"
+    preview = (schedule.get("text") or "").strip().replace("\n", " ")
+    if schedule.get("media"):
+        preview = f"[{_MEDIA_LABELS.get(schedule['media']['type'], '')}] " + preview
+    return text + f"\n📝 {preview[:60]}"
+
+
+# ================= حارس الإرسال =================
+SEND_RATE = float(os.getenv("SEND_RATE", "28"))  # رسالة/ثانية للبوت كله، حد Bot API حوالي 30
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", os.getenv("BROADCAST_MAX_RETRIES", "3")))
+SEND_PER_CHAT_RATE = float(os.getenv("SEND_PER_CHAT_RATE", "1"))  # رسالة/ثانية للمحادثة الخاصة
+SEND_GROUP_RATE_PER_MINUTE = float(os.getenv("SEND_GROUP_RATE_PER_MINUTE", "20"))
+SEND_PER_CHAT_BURST = float(os.getenv("SEND_PER_CHAT_BURST", "3"))
+
+# طلبات ترسل رسالة أو تعدلها فتخضع لحدود Telegram؛ البقية (get_chat_member، answer...) لا تُحدّ
+_LIMITED_ENDPOINTS = ("send", "edit", "copy", "forward")
+
+SEND_LIMITER = TokenBucket(SEND_RATE)
+
+
+class SendGuard(BaseRateLimiter):
+    """
+    كل طلب Bot API يمر من هنا (rate_limiter الخاص بـ ExtBot)، فلا يحتاج أي موضع إرسال منطق إعادة خاصاً به.
+    الرسالة تنتظر حد محادثتها ثم رمزاً من SEND_LIMITER العام.
+    RetryAfter يوقف الإرسال كله حتى تنتهي المهلة، وأخطاء الشبكة تُعاد بتأخير أُسّي مع jitter.
+    رسائل send* تنتظر RetryAfter مهما تكرر (الخطأ من حد البوت لا من الرسالة)؛ غير ذلك
+    بعد SEND_MAX_RETRIES يُرفع الخطأ للمستدعي وتُحسب الرسالة مُسقطة.
+    """
+
+    def __init__(self, max_retries: int = SEND_MAX_RETRIES):
+        self.max_retries = max_retries
+        self._chats: dict[int | str, TokenBucket] = {}
+        self.sent = 0
+        self.flood_wait = 0.0
+        self.retries = {"flood": 0, "network": 0}
+        self.dropped = {"flood": 0, "network": 0, "unreachable": 0, "rejected": 0}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_limiter(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats = {cid: b for cid, b in self._chats.items() if not b.idle()}
+            # المعرفات السالبة وأسماء @القنوات مجموعات/قنوات وحدها أبطأ
+            if isinstance(chat_id, str) or chat_id < 0:
+                bucket = TokenBucket(SEND_GROUP_RATE_PER_MINUTE / 60, SEND_PER_CHAT_BURST)
+            else:
+                bucket = TokenBucket(SEND_PER_CHAT_RATE, SEND_PER_CHAT_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _give_up(self, reason: str, endpoint: str, chat_id, error: TelegramError):
+        self.dropped[reason] += 1
+        logger.warning("Dropped %s to %s after %s retries: %s", endpoint, chat_id, self.max_retries, error)
+
+    def _reject(self, error: TelegramError):
+        self.dropped["unreachable" if classify_send_error(error) == SEND_UNREACHABLE else "rejected"] += 1
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        limited = endpoint.startswith(_LIMITED_ENDPOINTS)
+        chat_id = data.get("chat_id")
+        attempt = 0
+        while True:
+            if limited:
+                if chat_id is not None:
+                    await self._chat_limiter(chat_id).acquire()
+                await SEND_LIMITER.acquire()
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                wait = float(e.retry_after) + random.random()
+                SEND_LIMITER.block_for(wait)
+                self.flood_wait += wait
+                if not endpoint.startswith("send"):
+                    if attempt >= self.max_retries:
+                        self._give_up("flood", endpoint, chat_id, e)
+                        raise
+                    attempt += 1
+                self.retries["flood"] += 1
+                if not limited:
+                    # الطلبات المحدودة تنتظر المهلة داخل SEND_LIMITER.acquire
+                    await asyncio.sleep(wait)
+                continue
+            except BadRequest as e:
+                # BadRequest يرث NetworkError لكن إعادته لن تغير النتيجة
+                if limited and "not modified" not in e.message.lower():
+                    self._reject(e)
+                raise
+            except NetworkError as e:
+                if attempt >= self.max_retries:
+                    self._give_up("network", endpoint, chat_id, e)
+                    raise
+                attempt += 1
+                self.retries["network"] += 1
+                await asyncio.sleep(min(30, 2 ** attempt) + random.random())
+                continue
+            except TelegramError as e:
+                if limited:
+                    self._reject(e)
+                raise
+            if limited:
+                self.sent += 1
+            return result
+
+    def metrics(self) -> dict:
+        return {
+            "sent": self.sent,
+            "retries": dict(self.retries),
+            "dropped": dict(self.dropped),
+            "flood_wait_seconds": round(self.flood_wait, 1),
+        }
+
+
+SEND_GUARD = SendGuard()
+
+
+# ================= طابور الإشعارات =================
+NOTIFY_PER_CHAT_INTERVAL = float(os.getenv("NOTIFY_PER_CHAT_INTERVAL", "1"))  # بالثواني بين رسالتين لنفس المحادثة
+NOTIFY_DIGEST_INTERVAL = float(os.getenv("NOTIFY_DIGEST_INTERVAL", "300"))  # بالثواني
+NOTIFY_DIGEST_SAMPLE = max(1, int(os.getenv("NOTIFY_DIGEST_SAMPLE", "5")))  # الملخص يعرض عينة واحدة على الأقل
+NOTIFY_DRAIN_TIMEOUT = float(os.getenv("NOTIFY_DRAIN_TIMEOUT", "10"))  # بالثواني عند الإيقاف
+NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", "8"))
+NOTIFY_SAVE_INTERVAL = float(os.getenv("NOTIFY_SAVE_INTERVAL", "5"))  # بالثواني بين حفظين للطابور
+
+
+class NotificationQueue:
+    """
+    الإشعارات الفردية (للأدمن وللمستخدمين) تُرسل من الخلفية فلا تؤخر رد المستخدم.
+    الحدود وإعادة المحاولة يتولاها SEND_GUARD. كل رسالة تُرسل في مهمة مستقلة (حتى NOTIFY_CONCURRENCY)،
+    فمحادثة عالقة في إعادة المحاولة لا تؤخر غيرها؛ ورسائل نفس المحادثة تخرج بالترتيب
+    وبفاصل NOTIFY_PER_CHAT_INTERVAL.
+    تنبيهات دخول المستخدمين تُجمع وتُرسل للأدمن كملخص دوري، ولا يُعلَّم المستخدم announced
+    إلا بعد وصول الملخص الذي يذكره.
+    الطابور يُحفظ في NOTIFICATIONS_FILE كل NOTIFY_SAVE_INTERVAL إذا تغير، فما أُرسل لا يُعاد
+    بعد توقف مفاجئ. عند الإيقاف يُرسل الملخص المعلق وما في الطابور حتى NOTIFY_DRAIN_TIMEOUT،
+    والباقي يُحفظ ويُعاد للطابور عند التشغيل التالي.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._heap: list[tuple[float, int, int, str, object, tuple[int, ...]]] = []
+        self._seq = 0
+        self._next_allowed: dict[int, float] = {}
+        self._wakeup = asyncio.Event()
+        self._sending = 0
+        self._busy: set[int] = set()  # محادثات لها رسالة قيد الإرسال
+        self._held: dict[int, list[tuple]] = {}  # رسائل تنتظر انتهاء رسالة سابقة لنفس المحادثة
+        self._tasks: set[asyncio.Task] = set()
+        self._slots = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+        self._joins: dict[int, dict[int, str | None]] = {}
+        self._changed = False
+
+    def _push(self, ready_at: float, chat_id: int, text: str, reply_markup=None, announce: tuple[int, ...] = ()):
+        self._seq += 1
+        heapq.heappush(self._heap, (ready_at, self._seq, int(chat_id), text, reply_markup, announce))
+        self._changed = True
+        self._wakeup.set()
+
+    def send(self, chat_id: int, text: str, reply_markup=None, announce: tuple[int, ...] = ()):
+        self._push(time.monotonic(), chat_id, text, reply_markup, announce)
+
+    def join_alert(self, chat_id: int, user):
+        pending = self._joins.setdefault(chat_id, {})
+        if user.id in pending:
+            return
+        sample = None
+        if len(pending) < NOTIFY_DIGEST_SAMPLE:
+            username = f"@{user.username}" if user.username else "بدون"
+            full_name = (user.full_name or "").strip() or "بدون"
+            sample = f"ID: {user.id}\nUsername: {username}\nName: {full_name}"
+        pending[user.id] = sample
+
+    def _flush_joins(self):
+        minutes = max(1, round(NOTIFY_DIGEST_INTERVAL / 60))
+        for chat_id, pending in self._joins.items():
+            samples = [sample for sample in pending.values() if sample]
+            if len(pending) == 1:
+                text = "🚨 مستخدم دخل البوت\n" + samples[0]
+            else:
+                text = f"🚨 {len(pending)} مستخدم دخلوا البوت خلال آخر {minutes} دقيقة\n\nعينة:\n\n" + "\n\n".join(samples)
+            self.send(chat_id, text, announce=tuple(pending))
+        self._joins.clear()
+
+    async def _digest_loop(self):
+        while True:
+            await asyncio.sleep(NOTIFY_DIGEST_INTERVAL)
+            self._flush_joins()
+
+    async def _save_loop(self):
+        while True:
+            await asyncio.sleep(NOTIFY_SAVE_INTERVAL)
+            if self._changed:
+                self.save()
+
+    async def _deliver(self, bot, chat_id: int, text: str, reply_markup, announce: tuple[int, ...]):
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+        except TelegramError as e:
+            if classify_send_error(e) == SEND_UNREACHABLE:
+                USER_STORE.mark_inactive(chat_id)
+            return
+        except Exception:
+            logger.exception("Failed to deliver notification to %s", chat_id)
+            return
+        for user_id in announce:
+            record = USER_STORE.get(user_id)
+            if record is not None and not record.announced:
+                record.announced = True
+                USER_STORE.mark_dirty(user_id)
+
+    async def _deliver_loop(self, bot):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            ready_at, seq, chat_id, text, reply_markup, announce = self._heap[0]
+            now = time.monotonic()
+            if chat_id in self._busy:
+                # الرسالة السابقة لنفس المحادثة لم تنته؛ تعود للطابور عند انتهائها
+                self._held.setdefault(chat_id, []).append(heapq.heappop(self._heap))
+                continue
+            start = max(ready_at, self._next_allowed.get(chat_id, 0.0))
+            if start > ready_at:
+                # المحادثة وصلت حدها: نؤجل الرسالة بدل أن نحجز بقية المحادثات خلفها
+                heapq.heapreplace(self._heap, (start, seq, chat_id, text, reply_markup, announce))
+                continue
+            if start > now:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), start - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if self._slots.locked():
+                # كل المهام مشغولة؛ انتهاء أي منها يوقظ الحلقة
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            await self._slots.acquire()
+            heapq.heappop(self._heap)
+            self._busy.add(chat_id)
+            self._sending += 1
+            task = asyncio.create_task(self._send_one(bot, chat_id, text, reply_markup, announce))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send_one(self, bot, chat_id: int, text: str, reply_markup, announce: tuple[int, ...]):
+        try:
+            await self._deliver(bot, chat_id, text, reply_markup, announce)
+        finally:
+            now = time.monotonic()
+            if len(self._next_allowed) > 10000:
+                self._next_allowed = {cid: t for cid, t in self._next_allowed.items() if t > now}
+            self._next_allowed[chat_id] = now + NOTIFY_PER_CHAT_INTERVAL
+            self._busy.discard(chat_id)
+            for entry in self._held.pop(chat_id, ()):
+                heapq.heappush(self._heap, entry)
+            self._sending -= 1
+            self._changed = True
+            self._slots.release()
+            self._wakeup.set()
+
+    async def run(self, bot):
+        try:
+            await asyncio.gather(self._deliver_loop(bot), self._digest_loop(), self._save_loop())
+        finally:
+            for task in list(self._tasks):
+                task.cancel()
+
+    def load(self):
+        for item in _read_json(self.path, []):
+            markup = item.get("reply_markup")
+            self.send(
+                item["chat_id"],
+                item["text"],
+                InlineKeyboardMarkup.de_json(markup, None) if markup else None,
+                tuple(item.get("announce") or ()),
+            )
+
+    def save(self):
+        self._changed = False
+        items = [
+            {
+                "chat_id": chat_id,
+                "text": text,
+                "reply_markup": reply_markup.to_dict() if reply_markup else None,
+                "announce": list(announce),
+            }
+            for _, _, chat_id, text, reply_markup, announce in sorted(
+                self._heap + [entry for entries in self._held.values() for entry in entries]
+            )
+        ]
+        WRITER.submit(_write_json, self.path, items)
+
+    async def drain(self, timeout: float):
+        """يُستدعى عند الإيقاف والبوت ما زال متصلاً: يرسل ما أمكن ثم يحفظ الباقي."""
+        self._flush_joins()
+        deadline = time.monotonic() + timeout
+        while (self._heap or self._sending or self._held) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        pending = len(self._heap) + sum(len(entries) for entries in self._held.values())
+        if pending:
+            logger.warning("Saving %s undelivered notifications for the next start", pending)
+        self.save()
+
+
+NOTIFY_QUEUE = NotificationQueue(NOTIFICATIONS_FILE)
 
 
 # ================= أدوات عامة =================
@@ -180,8 +2525,7 @@ def is_admin(user_id: int | None) -> bool:
 def is_blocked(user_id: int | None) -> bool:
     if not user_id:
         return False
-    config = load_config()
-    return int(user_id) in set(config.get("blocked_users", []))
+    return int(user_id) in BLOCKLIST
 
 
 def is_bot_enabled() -> bool:
@@ -194,177 +2538,125 @@ def is_referral_enabled() -> bool:
     return bool(config.get("referral_enabled", True))
 
 
-def ensure_user_exists(user) -> dict:
-    users_data = load_users()
-    uid = str(user.id)
-
-    if uid not in users_data["users"]:
-        users_data["users"][uid] = {
-            "id": user.id,
-            "username": user.username or "",
-            "full_name": user.full_name or "",
-            "referred_by": None,
-            "pending_referrer_id": None,
-            "referrals": [],
-            "points": 0,
-            "total_points_earned": 0,
-            "redeem_count": 0,
-            "joined": True,
-            "human_verified": False,
-            "referral_counted": False,
-            "referral_reward_reverted": False,
-            "captcha_question": "",
-            "captcha_answer": None,
-        }
-    else:
-        users_data["users"][uid]["username"] = user.username or ""
-        users_data["users"][uid]["full_name"] = user.full_name or ""
-
-        if "referred_by" not in users_data["users"][uid]:
-            users_data["users"][uid]["referred_by"] = None
-        if "pending_referrer_id" not in users_data["users"][uid]:
-            users_data["users"][uid]["pending_referrer_id"] = None
-        if "referrals" not in users_data["users"][uid] or not isinstance(users_data["users"][uid]["referrals"], list):
-            users_data["users"][uid]["referrals"] = []
-        if "points" not in users_data["users"][uid]:
-            users_data["users"][uid]["points"] = 0
-        if "total_points_earned" not in users_data["users"][uid]:
-            users_data["users"][uid]["total_points_earned"] = 0
-        if "redeem_count" not in users_data["users"][uid]:
-            users_data["users"][uid]["redeem_count"] = 0
-        if "human_verified" not in users_data["users"][uid]:
-            users_data["users"][uid]["human_verified"] = False
-        if "referral_counted" not in users_data["users"][uid]:
-            users_data["users"][uid]["referral_counted"] = False
-        if "referral_reward_reverted" not in users_data["users"][uid]:
-            users_data["users"][uid]["referral_reward_reverted"] = False
-        if "captcha_question" not in users_data["users"][uid]:
-            users_data["users"][uid]["captcha_question"] = ""
-        if "captcha_answer" not in users_data["users"][uid]:
-            users_data["users"][uid]["captcha_answer"] = None
-
-    save_users(users_data)
-    return users_data["users"][uid]
+def ensure_user_exists(user) -> UserRecord:
+    user_data = USER_STORE.get(user.id)
+
+    if user_data is None:
+        user_data = USER_STORE.add(_new_user_record(user))
+        USER_STORE.touch(user.id)
+        return user_data
+
+    username = user.username or ""
+    full_name = user.full_name or ""
+    if user_data.username != username or user_data.full_name != full_name:
+        user_data.username = username
+        user_data.full_name = full_name
+        USER_STORE.mark_dirty(user.id)
+    USER_STORE.touch(user.id)
+
+    return user_data
 
 
 def set_pending_referral(new_user_id: int, referrer_id: int) -> bool:
     if new_user_id == referrer_id:
         return False
 
-    users_data = load_users()
-    new_uid = str(new_user_id)
-    ref_uid = str(referrer_id)
-
-    if new_uid not in users_data["users"] or ref_uid not in users_data["users"]:
+    new_user = USER_STORE.get(new_user_id)
+    if new_user is None or referrer_id not in USER_STORE:
         return False
 
-    new_user = users_data["users"][new_uid]
-
-    if new_user.get("referral_counted"):
+    if new_user.referral_counted:
         return False
-    if new_user.get("referred_by"):
+    if new_user.referred_by:
         return False
-    if new_user.get("pending_referrer_id"):
+    if new_user.pending_referrer_id:
         return False
 
-    new_user["pending_referrer_id"] = referrer_id
-    save_users(users_data)
+    new_user.pending_referrer_id = referrer_id
+    USER_STORE.mark_dirty(new_user_id)
     return True
 
 
 def finalize_referral(new_user_id: int) -> bool:
-    users_data = load_users()
     config = load_config()
 
-    new_uid = str(new_user_id)
-    if new_uid not in users_data["users"]:
+    new_user = USER_STORE.get(new_user_id)
+    if new_user is None:
         return False
 
-    new_user = users_data["users"][new_uid]
-    referrer_id = new_user.get("pending_referrer_id")
+    referrer_id = new_user.pending_referrer_id
 
     if not referrer_id:
         return False
     if new_user_id == referrer_id:
         return False
 
-    ref_uid = str(referrer_id)
-    if ref_uid not in users_data["users"]:
+    ref_user = USER_STORE.get(referrer_id)
+    if ref_user is None:
         return False
 
-    if new_user.get("referral_counted"):
+    if new_user.referral_counted:
         return False
-    if not new_user.get("human_verified"):
+    if not new_user.human_verified:
         return False
 
-    ref_user = users_data["users"][ref_uid]
-
-    new_user["referred_by"] = referrer_id
-    new_user["referral_counted"] = True
-    new_user["referral_reward_reverted"] = False
+    new_user.referred_by = referrer_id
+    new_user.referral_counted = True
+    new_user.referral_reward_reverted = False
 
-    referrals = ref_user.get("referrals", [])
-    if new_user_id not in referrals:
-        referrals.append(new_user_id)
-    ref_user["referrals"] = referrals
+    USER_STORE.referrals.add(referrer_id, new_user_id)
 
     points = int(config.get("referral_points_per_invite", 1))
-    ref_user["points"] = int(ref_user.get("points", 0)) + points
-    ref_user["total_points_earned"] = int(ref_user.get("total_points_earned", 0)) + points
+    add_points(referrer_id, points, "referral", earned=points)
 
-    save_users(users_data)
+    USER_STORE.mark_dirty(new_user_id)
+    USER_STORE.mark_dirty(referrer_id)
     return True
 
 
 def revert_referral_reward(left_user_id: int) -> tuple[bool, int | None]:
-    users_data = load_users()
     config = load_config()
 
-    uid = str(left_user_id)
-    if uid not in users_data["users"]:
+    left_user = USER_STORE.get(left_user_id)
+    if left_user is None:
         return False, None
 
-    left_user = users_data["users"][uid]
-
-    if not left_user.get("referral_counted"):
+    if not left_user.referral_counted:
         return False, None
-    if left_user.get("referral_reward_reverted"):
+    if left_user.referral_reward_reverted:
         return False, None
 
-    referrer_id = left_user.get("referred_by")
+    referrer_id = left_user.referred_by
     if not referrer_id:
         return False, None
 
-    ref_uid = str(referrer_id)
-    if ref_uid not in users_data["users"]:
-        left_user["referral_reward_reverted"] = True
-        save_users(users_data)
+    ref_user = USER_STORE.get(referrer_id)
+    if ref_user is None:
+        left_user.referral_reward_reverted = True
+        USER_STORE.mark_dirty(left_user_id)
         return False, referrer_id
 
-    ref_user = users_data["users"][ref_uid]
     points = int(config.get("referral_points_per_invite", 1))
 
-    ref_user["points"] = int(ref_user.get("points", 0)) - points
-    referrals = ref_user.get("referrals", [])
-    if left_user_id in referrals:
-        referrals.remove(left_user_id)
-    ref_user["referrals"] = referrals
+    add_points(referrer_id, -points, "referral_revert")
+    USER_STORE.referrals.remove(referrer_id, left_user_id)
 
-    left_user["referral_reward_reverted"] = True
+    left_user.referral_reward_reverted = True
 
-    save_users(users_data)
+    USER_STORE.mark_dirty(left_user_id)
+    USER_STORE.mark_dirty(referrer_id)
     return True, referrer_id
 
 
 def get_user_stats(user_id: int) -> dict:
-    users_data = load_users()
-    user_data = users_data["users"].get(str(user_id), {})
-    referrals = user_data.get("referrals", [])
+    user_data = USER_STORE.get(user_id)
+    if user_data is None:
+        return {"referrals_count": 0, "points": 0, "total_points_earned": 0, "redeem_count": 0}
     return {
-        "referrals_count": len(referrals),
-        "points": int(user_data.get("points", 0)),
-        "total_points_earned": int(user_data.get("total_points_earned", 0)),
-        "redeem_count": int(user_data.get("redeem_count", 0)),
+        "referrals_count": USER_STORE.referrals.count(user_id),
+        "points": user_data.points,
+        "total_points_earned": user_data.total_points_earned,
+        "redeem_count": user_data.redeem_count,
     }
 
 
@@ -377,76 +2669,53 @@ def get_bot_username(context: ContextTypes.DEFAULT_TYPE) -> str:
 
 
 def get_leaderboard(limit: int = 10) -> list:
-    users_data = load_users()
     items = []
 
-    for user in users_data.get("users", {}).values():
-        referrals_count = len(user.get("referrals", []))
-        if referrals_count > 0:
-            items.append(
-                {
-                    "full_name": (user.get("full_name") or "").strip() or "مستخدم",
-                    "referrals_count": referrals_count,
-                }
-            )
+    for referrer_id, referrals_count in USER_STORE.referrals.leaderboard:
+        user = USER_STORE.get(referrer_id)
+        if user is None:
+            continue
+        items.append(
+            {
+                "full_name": (user.full_name or "").strip() or "مستخدم",
+                "referrals_count": referrals_count,
+            }
+        )
+        if len(items) >= limit:
+            break
 
-    items.sort(key=lambda x: x["referrals_count"], reverse=True)
-    return items[:limit]
+    return items
 
 
 def get_next_reward_id() -> int:
-    rewards = load_rewards().get("items", [])
-    if not rewards:
-        return 1
-    return max(int(item.get("id", 0)) for item in rewards) + 1
+    return REWARDS.next_id()
 
 
 def get_reward_by_id(reward_id: int):
-    rewards = load_rewards().get("items", [])
-    for item in rewards:
-        if int(item.get("id", 0)) == int(reward_id):
-            return item
-    return None
+    return REWARDS.get(reward_id)
+
+
+def add_reward(name: str, cost: int) -> dict:
+    return REWARDS.add(name, cost)
 
 
 def delete_reward_by_id(reward_id: int) -> bool:
-    rewards_data = load_rewards()
-    old_items = rewards_data.get("items", [])
-    new_items = [item for item in old_items if int(item.get("id", 0)) != int(reward_id)]
-    if len(new_items) == len(old_items):
-        return False
-    rewards_data["items"] = new_items
-    save_rewards(rewards_data)
-    return True
+    return REWARDS.delete(reward_id)
 
 
 def update_reward_name(reward_id: int, new_name: str) -> bool:
-    rewards_data = load_rewards()
-    for item in rewards_data.get("items", []):
-        if int(item.get("id", 0)) == int(reward_id):
-            item["name"] = new_name
-            save_rewards(rewards_data)
-            return True
-    return False
+    return REWARDS.update(reward_id, "name", new_name)
 
 
 def update_reward_cost(reward_id: int, new_cost: int) -> bool:
-    rewards_data = load_rewards()
-    for item in rewards_data.get("items", []):
-        if int(item.get("id", 0)) == int(reward_id):
-            item["cost"] = new_cost
-            save_rewards(rewards_data)
-            return True
-    return False
+    return REWARDS.update(reward_id, "cost", new_cost)
 
 
 def user_has_pending_redeem(user_id: int) -> bool:
-    pending = load_pending_redeems().get("requests", {})
-    return str(user_id) in pending
+    return PENDING_REDEEMS.get(user_id) is not None
 
 
 def create_pending_redeem(user, reward_item: dict) -> dict:
-    pending_data = load_pending_redeems()
     request = {
         "user_id": user.id,
         "username": user.username or "",
@@ -456,28 +2725,20 @@ def create_pending_redeem(user, reward_item: dict) -> dict:
         "cost": int(reward_item["cost"]),
         "status": "pending",
     }
-    pending_data["requests"][str(user.id)] = request
-    save_pending_redeems(pending_data)
+    PENDING_REDEEMS.put(request)
     return request
 
 
 def get_pending_redeem(user_id: int):
-    pending = load_pending_redeems().get("requests", {})
-    return pending.get(str(user_id))
+    return PENDING_REDEEMS.get(user_id)
 
 
 def remove_pending_redeem(user_id: int):
-    pending_data = load_pending_redeems()
-    pending_data.get("requests", {}).pop(str(user_id), None)
-    save_pending_redeems(pending_data)
+    PENDING_REDEEMS.remove(user_id)
 
 
 def set_pending_redeem_status(user_id: int, status: str):
-    pending_data = load_pending_redeems()
-    req = pending_data.get("requests", {}).get(str(user_id))
-    if req:
-        req["status"] = status
-        save_pending_redeems(pending_data)
+    PENDING_REDEEMS.set_status(user_id, status)
 
 
 def normalize_channel_input(text: str) -> tuple[str, str]:
@@ -539,37 +2800,51 @@ def build_math_captcha() -> tuple[str, int]:
 
 
 def prepare_user_captcha(user_id: int) -> str:
-    users_data = load_users()
-    uid = str(user_id)
-    if uid not in users_data["users"]:
+    user_data = USER_STORE.get(user_id)
+    if user_data is None:
         raise ValueError("User not found")
 
     question, answer = build_math_captcha()
-    users_data["users"][uid]["captcha_question"] = question
-    users_data["users"][uid]["captcha_answer"] = int(answer)
-    save_users(users_data)
+    user_data.captcha_question = question
+    user_data.captcha_answer = int(answer)
+    USER_STORE.mark_dirty(user_id)
     return question
 
 
-def get_user_data(user_id: int) -> dict | None:
-    users_data = load_users()
-    return users_data["users"].get(str(user_id))
+def get_user_data(user_id: int) -> UserRecord | None:
+    return USER_STORE.get(user_id)
 
 
-async def is_user_subscribed(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
+async def is_user_subscribed(context: ContextTypes.DEFAULT_TYPE, user_id: int, refresh: bool = False) -> bool:
     config = load_config()
     forced_sub_channel = (config.get("forced_sub_channel") or "").strip()
 
     if not forced_sub_channel:
         return True
 
+    known = CHANNEL_MEMBERS.lookup(forced_sub_channel, user_id)
+    # زر التحقق لا يثق بـ "غير مشترك" المحلي: قد يكون حدث chat_member قد فات
+    if known or (known is not None and not refresh):
+        return known
+
+    if refresh:
+        MEMBERSHIP_CACHE.invalidate(user_id)
+    cached = MEMBERSHIP_CACHE.get(forced_sub_channel, user_id)
+    if cached is not None:
+        return cached
+
     try:
         member = await context.bot.get_chat_member(chat_id=forced_sub_channel, user_id=user_id)
         status = getattr(member, "status", "")
-        return status in ("member", "administrator", "creator", "restricted")
+        subscribed = status in SUBSCRIBED_STATUSES
     except Exception:
+        # أخطاء الشبكة لا تُحفظ في الكاش
         return False
 
+    MEMBERSHIP_CACHE.put(forced_sub_channel, user_id, subscribed)
+    CHANNEL_MEMBERS.record(forced_sub_channel, user_id, subscribed)
+    return subscribed
+
 
 def force_subscribe_menu() -> InlineKeyboardMarkup:
     config = load_config()
@@ -592,20 +2867,34 @@ async def apply_leave_penalty_if_needed(context: ContextTypes.DEFAULT_TYPE, user
     if not user_data:
         return
 
-    if not user_data.get("referral_counted"):
+    if not user_data.referral_counted:
         return
-    if user_data.get("referral_reward_reverted"):
+    if user_data.referral_reward_reverted:
         return
 
     changed, referrer_id = revert_referral_reward(user_id)
     if changed and referrer_id:
-        try:
-            await context.bot.send_message(
-                chat_id=referrer_id,
-                text="❌ تم خصم النقاط بسبب مغادرة الشخص المحال لقناة الاشتراك الإجباري.",
-            )
-        except Exception:
-            pass
+        NOTIFY_QUEUE.send(referrer_id, "❌ تم خصم النقاط بسبب مغادرة الشخص المحال لقناة الاشتراك الإجباري.")
+
+
+async def on_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    change = update.chat_member
+    if not change:
+        return
+
+    config = load_config()
+    forced_sub_channel = (config.get("forced_sub_channel") or "").strip()
+    if not forced_sub_channel or not ChannelMembers.matches(forced_sub_channel, change.chat):
+        return
+
+    user_id = change.new_chat_member.user.id
+    was_subscribed = change.old_chat_member.status in SUBSCRIBED_STATUSES
+    subscribed = change.new_chat_member.status in SUBSCRIBED_STATUSES
+    CHANNEL_MEMBERS.on_event(forced_sub_channel, user_id, subscribed)
+    MEMBERSHIP_CACHE.invalidate(user_id)
+
+    if was_subscribed and not subscribed:
+        await apply_leave_penalty_if_needed(context, user_id)
 
 
 async def maybe_prompt_human_check(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
@@ -616,14 +2905,14 @@ async def maybe_prompt_human_check(update: Update, context: ContextTypes.DEFAULT
     if not user_data:
         return False
 
-    if user_data.get("referral_counted"):
+    if user_data.referral_counted:
         return False
-    if user_data.get("human_verified"):
+    if user_data.human_verified:
         return False
-    if not user_data.get("pending_referrer_id"):
+    if not user_data.pending_referrer_id:
         return False
 
-    question = user_data.get("captcha_question") or prepare_user_captcha(user_id)
+    question = user_data.captcha_question or prepare_user_captcha(user_id)
 
     text = (
         "🤖 تحقق أمني بسيط\n\n"
@@ -734,7 +3023,9 @@ def admin_menu() -> InlineKeyboardMarkup:
         [
             [InlineKeyboardButton("🚫 حظر شخص", callback_data="admin_ban")],
             [InlineKeyboardButton("✅ فك حظر شخص", callback_data="admin_unban")],
-            [InlineKeyboardButton("📢 إذاعة للكل", callback_data="admin_broadcast")],
+            [InlineKeyboardButton("📥 حظر من ملف", callback_data="admin_ban_file")],
+            [InlineKeyboardButton("📢 إذاعة", callback_data="admin_broadcast")],
+            [InlineKeyboardButton("⏰ الإذاعات المجدولة", callback_data="admin_schedules")],
             [InlineKeyboardButton("🎁 إدارة الاستبدال", callback_data="admin_manage_rewards")],
             [InlineKeyboardButton("⭐ تعديل مكافأة الإحالة", callback_data="admin_ref_points")],
             [InlineKeyboardButton("🎯 منح نقاط", callback_data="admin_grant_points")],
@@ -747,6 +3038,35 @@ def admin_menu() -> InlineKeyboardMarkup:
     )
 
 
+def broadcast_segments_menu() -> InlineKeyboardMarkup:
+    rows = [
+        [InlineKeyboardButton(label, callback_data=f"bc_seg:{kind}")]
+        for kind, label in BROADCAST_SEGMENTS.items()
+    ]
+    rows.append([InlineKeyboardButton("🔙 رجوع", callback_data="admin_menu")])
+    return InlineKeyboardMarkup(rows)
+
+
+def schedules_menu() -> InlineKeyboardMarkup:
+    rows = [
+        [InlineKeyboardButton(f"🗑 حذف #{index}", callback_data=f"sched_del:{schedule_id}")]
+        for index, schedule_id in enumerate(SCHEDULER.schedules, start=1)
+    ]
+    rows.append([InlineKeyboardButton("➕ جدولة إذاعة", callback_data="sched_new")])
+    rows.append([InlineKeyboardButton("🔙 رجوع", callback_data="admin_menu")])
+    return InlineKeyboardMarkup(rows)
+
+
+def schedules_text() -> str:
+    if not SCHEDULER.schedules:
+        return "⏰ الإذاعات المجدولة\n\nلا توجد إذاعات مجدولة."
+    parts = [
+        f"#{index}\n{format_schedule(schedule)}"
+        for index, schedule in enumerate(SCHEDULER.schedules.values(), start=1)
+    ]
+    return "⏰ الإذاعات المجدولة\n\n" + "\n\n".join(parts)
+
+
 def admin_rewards_menu() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
@@ -822,6 +3142,11 @@ def fmt_number(d: Decimal) -> str:
     return format(d, "f").rstrip("0").rstrip(".")
 
 
+def parse_id_list(text: str) -> list[int]:
+    t = (text or "").translate(_ARABIC_DIGITS).translate(_EASTERN_ARABIC_DIGITS)
+    return [int(m) for m in re.findall(r"\d+", t)]
+
+
 def parse_int(text: str) -> int:
     t = (text or "").strip()
     t = t.translate(_ARABIC_DIGITS).translate(_EASTERN_ARABIC_DIGITS)
@@ -837,7 +3162,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not user:
         return
 
-    ensure_user_exists(user)
+    record = ensure_user_exists(user)
+    USER_STORE.reactivate(user.id)
 
     if is_blocked(user.id):
         await update.effective_message.reply_text(BLOCKED_TEXT)
@@ -848,20 +3174,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     admin_id = _get_admin_id()
-    if admin_id and user.id not in NOTIFIED_USERS:
-        NOTIFIED_USERS.add(user.id)
-        username = f"@{user.username}" if user.username else "بدون"
-        full_name = (user.full_name or "").strip() or "بدون"
-        msg = (
-            "🚨 مستخدم دخل البوت\n"
-            f"ID: {user.id}\n"
-            f"Username: {username}\n"
-            f"Name: {full_name}"
-        )
-        try:
-            await context.bot.send_message(chat_id=admin_id, text=msg)
-        except Exception:
-            pass
+    if admin_id and not record.announced:
+        NOTIFY_QUEUE.join_alert(admin_id, user)
 
     if context.args:
         try:
@@ -876,6 +3190,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.pop("new_reward_name", None)
     context.user_data.pop("selected_reward_id", None)
     context.user_data.pop("grant_points_user_id", None)
+    context.user_data.pop("broadcast_segment", None)
+    context.user_data.pop("broadcast_schedule", None)
+    context.user_data.pop("scheduled_broadcast", None)
 
     if not is_admin(user.id):
         subscribed = await is_user_subscribed(context, user.id)
@@ -918,7 +3235,7 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await q.edit_message_text(BOT_STOPPED_TEXT)
             return
 
-        subscribed = await is_user_subscribed(context, user.id)
+        subscribed = await is_user_subscribed(context, user.id, refresh=True)
         if not subscribed:
             await apply_leave_penalty_if_needed(context, user.id)
             await q.answer("❌ لم يتم العثور على اشتراكك بعد.", show_alert=True)
@@ -941,6 +3258,7 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     allowed = await enforce_access(update, context, user.id)
     if not allowed:
         return
+    USER_STORE.touch(user.id)
 
     context.user_data.pop(ADMIN_ACTION_KEY, None)
     context.user_data.pop(REFERRAL_ACTION_KEY, None)
@@ -1061,20 +3379,18 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await q.answer("طلبك قيد المراجعة، انتظر رد الإدارة.", show_alert=True)
             return
 
-        users_data = load_users()
-        user_data = users_data["users"].get(str(user.id))
+        user_data = get_user_data(user.id)
         if not user_data:
             return
 
-        current_points = int(user_data.get("points", 0))
+        current_points = user_data.points
         cost = int(item.get("cost", 0))
 
         if current_points < cost:
             await q.answer("❌ نقاطك غير كافية لهذا الاستبدال.", show_alert=True)
             return
 
-        user_data["points"] = current_points - cost
-        save_users(users_data)
+        add_points(user.id, -cost, "redeem")
 
         create_pending_redeem(user, item)
 
@@ -1090,14 +3406,7 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"🎁 السلعة: {item['name']}\n"
                 f"⭐ التكلفة: {cost} نقطة"
             )
-            try:
-                await context.bot.send_message(
-                    chat_id=admin_id,
-                    text=admin_msg,
-                    reply_markup=admin_redeem_request_menu(user.id),
-                )
-            except Exception:
-                pass
+            NOTIFY_QUEUE.send(admin_id, admin_msg, reply_markup=admin_redeem_request_menu(user.id))
 
         await q.edit_message_text(
             "✅ تم إرسال طلب الاستبدال إلى الإدارة بنجاح.",
@@ -1135,12 +3444,78 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    if q.data == "admin_broadcast":
+    if q.data == "admin_ban_file":
+        if not is_admin(user.id):
+            return
+        context.user_data[ADMIN_ACTION_KEY] = ADMIN_WAIT_BAN_FILE
+        await q.edit_message_text(
+            "📥 حظر من ملف\n\n"
+            "أرسل الآن ملفاً نصياً (txt أو csv) يحتوي IDs المستخدمين المراد حظرهم،\n"
+            "ID في كل سطر أو مفصولة بفواصل.",
+            reply_markup=admin_menu(),
+        )
+        return
+
+    if q.data.startswith(("bc_pause:", "bc_resume:", "bc_cancel:")):
+        if not is_admin(user.id):
+            return
+        action, job_id = q.data.split(":", 1)
+        if action == "bc_pause":
+            job = BROADCASTS.pause(job_id)
+        elif action == "bc_resume":
+            job = BROADCASTS.resume(context.bot, job_id)
+        else:
+            job = BROADCASTS.cancel(job_id)
+        if job is None:
+            await q.edit_message_text("❌ هذه الإذاعة لم تعد موجودة.", reply_markup=admin_menu())
+            return
+        # المهمة الجارية ستحدّث الرسالة بنفسها عند توقف العمال
+        if job.id not in BROADCASTS.tasks:
+            await q.edit_message_text(job.status_text(), reply_markup=job.controls())
+        return
+
+    if q.data == "admin_schedules":
+        if not is_admin(user.id):
+            return
+        await q.edit_message_text(schedules_text(), reply_markup=schedules_menu())
+        return
+
+    if q.data.startswith("sched_del:"):
+        if not is_admin(user.id):
+            return
+        SCHEDULER.remove(q.data.split(":", 1)[1])
+        await q.edit_message_text(schedules_text(), reply_markup=schedules_menu())
+        return
+
+    if q.data in ("admin_broadcast", "sched_new"):
+        if not is_admin(user.id):
+            return
+        context.user_data.pop(ADMIN_ACTION_KEY, None)
+        context.user_data["broadcast_schedule"] = q.data == "sched_new"
+        await q.edit_message_text(
+            "📢 إذاعة\n\nاختر الفئة التي تريد الإرسال إليها:",
+            reply_markup=broadcast_segments_menu(),
+        )
+        return
+
+    if q.data.startswith("bc_seg:"):
         if not is_admin(user.id):
             return
+        kind = q.data.split(":", 1)[1]
+        if kind not in BROADCAST_SEGMENTS:
+            return
+        segment = {"kind": kind}
+        context.user_data["broadcast_segment"] = segment
+        if kind in _SEGMENTS_WITH_VALUE:
+            context.user_data[ADMIN_ACTION_KEY] = ADMIN_WAIT_BROADCAST_SEGMENT_VALUE
+            prompt = "أرسل الحد الأدنى للنقاط." if kind == "points" else "أرسل عدد الأيام."
+            await q.edit_message_text(f"📢 {BROADCAST_SEGMENTS[kind]}\n\n{prompt}", reply_markup=admin_menu())
+            return
         context.user_data[ADMIN_ACTION_KEY] = ADMIN_WAIT_BROADCAST
         await q.edit_message_text(
-            "📢 إذاعة للكل\n\nأرسل الآن الرسالة التي تريد إرسالها لجميع المستخدمين.",
+            f"📢 {segment_label(segment)}\n\n"
+            f"👥 عدد المستهدفين: {len(resolve_segment(segment))}\n\n"
+            "أرسل الآن الرسالة التي تريد إرسالها (نص، صورة، فيديو أو ملف).",
             reply_markup=admin_menu(),
         )
         return
@@ -1222,13 +3597,19 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if q.data == "admin_user_count":
         if not is_admin(user.id):
             return
-        users_data = load_users()
-        blocked = len(load_config().get("blocked_users", []))
-        total = len(users_data.get("users", {}))
+        blocked = len(BLOCKLIST)
+        total = len(USER_STORE)
+        inactive = len(USER_STORE.inactive)
         await q.edit_message_text(
             "📊 إحصائيات المستخدمين\n\n"
             f"👥 إجمالي المستخدمين: {total}\n"
-            f"⛔ عدد المحظورين: {blocked}",
+            f"✅ النشطون: {total - inactive}\n"
+            f"🚫 غير النشطين (حظروا البوت أو حذفوا الحساب): {inactive}\n"
+            f"⛔ عدد المحظورين: {blocked}\n\n"
+            f"📡 كاش الاشتراك: {MEMBERSHIP_CACHE.hit_rate():.0%} إصابة "
+            f"({MEMBERSHIP_CACHE.hits}/{MEMBERSHIP_CACHE.hits + MEMBERSHIP_CACHE.misses})\n"
+            f"📤 الرسائل المرسلة: {SEND_GUARD.sent} | إعادات: {SEND_GUARD.retries['flood']} حد Telegram، "
+            f"{SEND_GUARD.retries['network']} شبكة | مُسقطة: {sum(SEND_GUARD.dropped.values())}",
             reply_markup=admin_menu(),
         )
         return
@@ -1379,22 +3760,15 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await q.answer("❌ الطلب غير موجود أو تمت معالجته.", show_alert=True)
             return
 
-        users_data = load_users()
-        user_data = users_data["users"].get(str(target_user_id))
+        user_data = get_user_data(target_user_id)
         if user_data:
-            user_data["redeem_count"] = int(user_data.get("redeem_count", 0)) + 1
-            save_users(users_data)
+            user_data.redeem_count += 1
+            USER_STORE.mark_dirty(target_user_id)
 
         set_pending_redeem_status(target_user_id, "accepted")
         remove_pending_redeem(target_user_id)
 
-        try:
-            await context.bot.send_message(
-                chat_id=target_user_id,
-                text="✅ تم قبول طلبك.",
-            )
-        except Exception:
-            pass
+        NOTIFY_QUEUE.send(target_user_id, "✅ تم قبول طلبك.")
 
         await q.edit_message_text("✅ تم قبول الطلب.")
         return
@@ -1414,22 +3788,12 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await q.answer("❌ الطلب غير موجود أو تمت معالجته.", show_alert=True)
             return
 
-        users_data = load_users()
-        user_data = users_data["users"].get(str(target_user_id))
-        if user_data:
-            user_data["points"] = int(user_data.get("points", 0)) + int(req.get("cost", 0))
-            save_users(users_data)
+        add_points(target_user_id, int(req.get("cost", 0)), "redeem_refund")
 
         set_pending_redeem_status(target_user_id, "rejected")
         remove_pending_redeem(target_user_id)
 
-        try:
-            await context.bot.send_message(
-                chat_id=target_user_id,
-                text="❌ تم رفض طلبك وتم استرجاع نقاطك.",
-            )
-        except Exception:
-            pass
+        NOTIFY_QUEUE.send(target_user_id, "❌ تم رفض طلبك وتم استرجاع نقاطك.")
 
         await q.edit_message_text("❌ تم رفض الطلب وإرجاع النقاط للمستخدم.")
         return
@@ -1463,18 +3827,18 @@ async def handle_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         user_data = get_user_data(user.id)
-        if user_data and user_data.get("pending_referrer_id") and not user_data.get("human_verified"):
+        if user_data and user_data.pending_referrer_id and not user_data.human_verified:
             try:
                 answer = parse_int(text)
             except Exception:
-                question = user_data.get("captcha_question") or prepare_user_captcha(user.id)
+                question = user_data.captcha_question or prepare_user_captcha(user.id)
                 await update.effective_message.reply_text(
                     "❌ أرسل جواب سؤال التحقق كرقم فقط.\n\n"
                     f"السؤال: {question}"
                 )
                 return
 
-            expected = user_data.get("captcha_answer")
+            expected = user_data.captcha_answer
             if expected is None:
                 question = prepare_user_captcha(user.id)
                 await update.effective_message.reply_text(
@@ -1494,21 +3858,20 @@ async def handle_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
 
-            users_data = load_users()
-            target_user = users_data["users"].get(str(user.id))
+            target_user = get_user_data(user.id)
             if not target_user:
                 return
 
-            target_user["human_verified"] = True
-            target_user["captcha_question"] = ""
-            target_user["captcha_answer"] = None
-            save_users(users_data)
+            target_user.human_verified = True
+            target_user.captcha_question = ""
+            target_user.captcha_answer = None
+            USER_STORE.mark_dirty(user.id)
 
             counted = finalize_referral(user.id)
 
             if counted:
                 current_user_data = get_user_data(user.id)
-                referrer_id = current_user_data.get("referred_by") if current_user_data else None
+                referrer_id = current_user_data.referred_by if current_user_data else None
 
                 if referrer_id:
                     config = load_config()
@@ -1521,10 +3884,7 @@ async def handle_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         f"🔗 Username: {username}\n"
                         f"⭐ تمت إضافة {points} نقطة إلى رصيدك"
                     )
-                    try:
-                        await context.bot.send_message(chat_id=referrer_id, text=notify_text)
-                    except Exception:
-                        pass
+                    NOTIFY_QUEUE.send(referrer_id, notify_text)
 
             await update.effective_message.reply_text(
                 "✅ تم التحقق منك بنجاح وتم احتساب الإحالة.\n\n" + WELCOME_TEXT,
@@ -1539,11 +3899,7 @@ async def handle_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if admin_action == ADMIN_WAIT_BAN:
             try:
                 target_id = parse_int(text)
-                config = load_config()
-                blocked_users = set(config.get("blocked_users", []))
-                blocked_users.add(target_id)
-                config["blocked_users"] = sorted(blocked_users)
-                save_config(config)
+                BLOCKLIST.add(target_id)
                 context.user_data.pop(ADMIN_ACTION_KEY, None)
 
                 await update.effective_message.reply_text(
@@ -1560,11 +3916,7 @@ async def handle_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if admin_action == ADMIN_WAIT_UNBAN:
             try:
                 target_id = parse_int(text)
-                config = load_config()
-                blocked_users = set(config.get("blocked_users", []))
-                blocked_users.discard(target_id)
-                config["blocked_users"] = sorted(blocked_users)
-                save_config(config)
+                BLOCKLIST.remove(target_id)
                 context.user_data.pop(ADMIN_ACTION_KEY, None)
 
                 await update.effective_message.reply_text(
@@ -1578,24 +3930,50 @@ async def handle_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
             return
 
-        if admin_action == ADMIN_WAIT_BROADCAST:
-            users_data = load_users()
-            users = users_data.get("users", {})
-            sent = 0
-            failed = 0
+        if admin_action == ADMIN_WAIT_BROADCAST_SEGMENT_VALUE:
+            try:
+                value = parse_int(text)
+                if value < 0:
+                    raise ValueError("Negative value")
+            except Exception:
+                await update.effective_message.reply_text(
+                    "❌ أرسل رقمًا صحيحًا فقط.",
+                    reply_markup=admin_menu(),
+                )
+                return
+            segment = context.user_data.setdefault("broadcast_segment", {"kind": "all"})
+            segment["value"] = value
+            context.user_data[ADMIN_ACTION_KEY] = ADMIN_WAIT_BROADCAST
+            await update.effective_message.reply_text(
+                f"📢 {segment_label(segment)}\n\n"
+                f"👥 عدد المستهدفين: {len(resolve_segment(segment))}\n\n"
+                "أرسل الآن الرسالة التي تريد إرسالها (نص، صورة، فيديو أو ملف).",
+                reply_markup=admin_menu(),
+            )
+            return
 
-            for uid in users:
-                try:
-                    await context.bot.send_message(chat_id=int(uid), text=text)
-                    sent += 1
-                except Exception:
-                    failed += 1
+        if admin_action == ADMIN_WAIT_BROADCAST:
+            await start_broadcast(update, context, text)
+            return
 
+        if admin_action == ADMIN_WAIT_BROADCAST_TIME:
+            pending = context.user_data.get("scheduled_broadcast")
+            if not pending:
+                context.user_data.pop(ADMIN_ACTION_KEY, None)
+                return
+            try:
+                run_at, interval = parse_schedule_time(text)
+            except ValueError:
+                await update.effective_message.reply_text(
+                    "❌ صيغة غير صحيحة. مثال: 2025-01-31 03:00 أو 03:00 24",
+                    reply_markup=admin_menu(),
+                )
+                return
             context.user_data.pop(ADMIN_ACTION_KEY, None)
+            context.user_data.pop("scheduled_broadcast", None)
+            schedule = SCHEDULER.add(pending["text"], pending["media"], pending["segment"], run_at, interval)
             await update.effective_message.reply_text(
-                "📢 انتهت الإذاعة\n\n"
-                f"✅ تم الإرسال إلى: {sent}\n"
-                f"❌ فشل الإرسال إلى: {failed}",
+                "✅ تمت جدولة الإذاعة\n\n" + format_schedule(schedule),
                 reply_markup=admin_menu(),
             )
             return
@@ -1622,8 +4000,7 @@ async def handle_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if admin_action == ADMIN_WAIT_GRANT_POINTS_USER_ID:
             try:
                 target_id = parse_int(text)
-                users_data = load_users()
-                if str(target_id) not in users_data.get("users", {}):
+                if target_id not in USER_STORE:
                     await update.effective_message.reply_text(
                         "❌ هذا المستخدم غير موجود في السجل.",
                         reply_markup=admin_menu(),
@@ -1648,25 +4025,13 @@ async def handle_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 amount = parse_int(text)
                 target_id = int(context.user_data.get("grant_points_user_id"))
-                users_data = load_users()
-                user_data = users_data["users"].get(str(target_id))
-                if not user_data:
+                if not add_points(target_id, amount, "admin_grant", earned=amount):
                     raise ValueError("User not found")
 
-                user_data["points"] = int(user_data.get("points", 0)) + amount
-                user_data["total_points_earned"] = int(user_data.get("total_points_earned", 0)) + amount
-                save_users(users_data)
-
                 context.user_data.pop("grant_points_user_id", None)
                 context.user_data.pop(ADMIN_ACTION_KEY, None)
 
-                try:
-                    await context.bot.send_message(
-                        chat_id=target_id,
-                        text=f"⭐ تم إضافة {amount} نقطة إلى حسابك.",
-                    )
-                except Exception:
-                    pass
+                NOTIFY_QUEUE.send(target_id, f"⭐ تم إضافة {amount} نقطة إلى حسابك.")
 
                 await update.effective_message.reply_text(
                     f"✅ تم منح {amount} نقطة للمستخدم: {target_id}",
@@ -1688,6 +4053,7 @@ async def handle_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     config["forced_sub_channel"] = ""
                     config["forced_sub_link"] = ""
                     save_config(config)
+                    MEMBERSHIP_CACHE.clear()
                     context.user_data.pop(ADMIN_ACTION_KEY, None)
 
                     await update.effective_message.reply_text(
@@ -1713,6 +4079,7 @@ async def handle_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 config["forced_sub_channel"] = forced_sub_channel
                 config["forced_sub_link"] = forced_sub_link
                 save_config(config)
+                MEMBERSHIP_CACHE.clear()
                 context.user_data.pop(ADMIN_ACTION_KEY, None)
 
                 await update.effective_message.reply_text(
@@ -1751,15 +4118,7 @@ async def handle_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 if not item_name:
                     raise ValueError("Missing item name")
 
-                rewards_data = load_rewards()
-                rewards_data["items"].append(
-                    {
-                        "id": get_next_reward_id(),
-                        "name": item_name,
-                        "cost": cost,
-                    }
-                )
-                save_rewards(rewards_data)
+                add_reward(item_name, cost)
 
                 context.user_data.pop("new_reward_name", None)
                 context.user_data.pop(ADMIN_ACTION_KEY, None)
@@ -1861,17 +4220,519 @@ async def handle_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.effective_message.reply_text(reply, reply_markup=back_menu(user.id))
 
 
+_BACKGROUND_TASKS: list[asyncio.Task] = []
+
+
+async def post_init(app: Application):
+    _BACKGROUND_TASKS.append(asyncio.create_task(_users_flush_loop()))
+    _BACKGROUND_TASKS.append(asyncio.create_task(_points_ledger_loop()))
+    BROADCASTS.resume_all(app.bot)
+    SCHEDULER.install(app.job_queue)
+    _BACKGROUND_TASKS.append(asyncio.create_task(NOTIFY_QUEUE.run(app.bot)))
+    _BACKGROUND_TASKS.append(asyncio.create_task(_update_offset_loop()))
+    if STARTUP_UPDATES == "replay":
+        await catch_up(app)
+
+
+async def post_stop(app: Application):
+    # بعد توقف استقبال التحديثات وقبل إغلاق اتصال البوت
+    await NOTIFY_QUEUE.drain(NOTIFY_DRAIN_TIMEOUT)
+
+
+async def post_shutdown(app: Application):
+    for task in _BACKGROUND_TASKS:
+        task.cancel()
+    await asyncio.gather(*_BACKGROUND_TASKS, return_exceptions=True)
+    _BACKGROUND_TASKS.clear()
+    await BROADCASTS.stop()
+    UPDATE_OFFSET.save()
+    POINTS_LEDGER.close()
+    USER_STORE.flush()
+    # ننتظر انتهاء كل ما في طابور الكتابة قبل إغلاق قاعدة البيانات
+    WRITER.shutdown()
+    if isinstance(STORAGE, SqliteStorage):
+        STORAGE.close()
+
+
+async def start_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, media: dict | None = None):
+    context.user_data.pop(ADMIN_ACTION_KEY, None)
+    segment = context.user_data.pop("broadcast_segment", None) or {"kind": "all"}
+    if context.user_data.pop("broadcast_schedule", False):
+        context.user_data["scheduled_broadcast"] = {"text": text, "media": media, "segment": segment}
+        context.user_data[ADMIN_ACTION_KEY] = ADMIN_WAIT_BROADCAST_TIME
+        offset = SCHEDULE_TZ.utcoffset(None).total_seconds() / 3600
+        await update.effective_message.reply_text(
+            "⏰ متى تريد إرسالها؟\n\n"
+            "أرسل الوقت بصيغة YYYY-MM-DD HH:MM أو HH:MM لأقرب موعد قادم.\n"
+            "لتكرارها أضف عدد الساعات بعد الوقت، مثل: 03:00 24\n\n"
+            f"التوقيت المستخدم: UTC{offset:+g}",
+            reply_markup=admin_menu(),
+        )
+        return
+    job = BROADCASTS.create(text, segment, media)
+    status_message = await update.effective_message.reply_text(job.status_text(), reply_markup=job.controls())
+    job.chat_id = status_message.chat_id
+    job.message_id = status_message.message_id
+    BROADCASTS.start(context.bot, job)
+
+
+def extract_media(message) -> dict | None:
+    # file_id الخاص برسالة الأدمن يُعاد استخدامه لكل المستلمين دون رفع الملف من جديد
+    if message.photo:
+        return {"type": "photo", "file_id": message.photo[-1].file_id}
+    if message.video:
+        return {"type": "video", "file_id": message.video.file_id}
+    if message.document:
+        return {"type": "document", "file_id": message.document.file_id}
+    return None
+
+
+async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not user or not is_admin(user.id):
+        return
+
+    admin_action = context.user_data.get(ADMIN_ACTION_KEY)
+
+    if admin_action == ADMIN_WAIT_BROADCAST:
+        message = update.effective_message
+        media = extract_media(message)
+        if media is None:
+            return
+        await start_broadcast(update, context, message.caption or "", media)
+        return
+
+    if admin_action == ADMIN_WAIT_BAN_FILE:
+        document = update.effective_message.document
+        if document is None:
+            return
+        if document.file_size and document.file_size > MAX_BAN_FILE_SIZE:
+            await update.effective_message.reply_text(
+                "❌ الملف كبير جداً.",
+                reply_markup=admin_menu(),
+            )
+            return
+
+        try:
+            tg_file = await document.get_file()
+            raw = await tg_file.download_as_bytearray()
+            ids = parse_id_list(bytes(raw).decode("utf-8", errors="ignore"))
+        except Exception:
+            await update.effective_message.reply_text(
+                "❌ تعذر قراءة الملف.",
+                reply_markup=admin_menu(),
+            )
+            return
+
+        if not ids:
+            await update.effective_message.reply_text(
+                "❌ لم أجد أي ID داخل الملف.",
+                reply_markup=admin_menu(),
+            )
+            return
+
+        added = BLOCKLIST.add_many(ids)
+        context.user_data.pop(ADMIN_ACTION_KEY, None)
+
+        await update.effective_message.reply_text(
+            "✅ تم استيراد قائمة الحظر\n\n"
+            f"📄 IDs في الملف: {len(ids)}\n"
+            f"🚫 محظورون جدد: {added}\n"
+            f"⛔ إجمالي المحظورين: {len(BLOCKLIST)}",
+            reply_markup=admin_menu(),
+        )
+        return
+
+
+# ================= معالجة متزامنة للتحديثات =================
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    تحديثات المستخدمين المختلفين تُعالج بالتوازي، وتحديثات نفس المستخدم بالتتابع
+    وبترتيب وصولها (asyncio.Lock يخدم المنتظرين بالترتيب)، فلا تتسابق على نقاطه أو حالة الكابتشا.
+    الحد الفعلي للتوازي يُطبق بعد أخذ قفل المستخدم، حتى لا يحجز مستخدم يرسل بكثرة
+    كل الأماكن وهو ينتظر دوره.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        # حد الأساس هنا لعدد التحديثات المنتظرة فقط
+        super().__init__(max_concurrent_updates * 16)
+        self._active = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._waiting: dict[int, int] = {}
+
+    @staticmethod
+    def _key(update: object) -> int | None:
+        if not isinstance(update, Update):
+            return None
+        if update.chat_member:
+            # المعني بالتحديث هو العضو نفسه لا من قام بالتغيير
+            return update.chat_member.new_chat_member.user.id
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine):
+        update_id = update.update_id if isinstance(update, Update) else None
+        if update_id is not None and not UPDATE_OFFSET.begin(update_id):
+            coroutine.close()
+            return
+        try:
+            await self._process(update, coroutine)
+        finally:
+            if update_id is not None:
+                UPDATE_OFFSET.finish(update_id)
+
+    async def _process(self, update: object, coroutine):
+        key = self._key(update)
+        if key is None:
+            async with self._active:
+                await coroutine
+            return
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._waiting[key] = self._waiting.get(key, 0) + 1
+        try:
+            async with lock, self._active:
+                await coroutine
+        finally:
+            self._waiting[key] -= 1
+            if not self._waiting[key]:
+                del self._waiting[key]
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# ================= التحديثات المتأخرة عند التشغيل =================
+class UpdateOffset:
+    """
+    آخر update_id عولج هو وكل ما قبله، محفوظ على القرص.
+    الحد المحفوظ (floor) يُطبق فقط على طابور catch_up عند التشغيل، وأثناء التشغيل يُتجاهل ما تكرر وصوله.
+    Telegram يعيد ترقيم التحديثات من رقم عشوائي بعد أسبوع بلا تحديثات، لذلك يُهمل الحد
+    إن كان أقدم من MAX_AGE أو بدأ الطابور برقم دونه بأكثر من دفعة.
+    """
+
+    RECENT_LIMIT = 10_000
+    MAX_AGE = 6 * 86400  # أقل من أسبوع إعادة الترقيم
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.floor = 0
+        self.saved_at: float | None = None  # آخر حفظ = آخر وقت كان البوت فيه يعمل
+        self.duplicates = 0
+        self._in_flight: set[int] = set()
+        self._recent: set[int] = set()
+        self._recent_order: list[int] = []
+        self._high = 0
+
+    def load(self):
+        data = _read_json(self.path, {})
+        self.saved_at = data.get("saved_at")
+        if self.saved_at and time.time() - self.saved_at > self.MAX_AGE:
+            return
+        self.floor = self._high = int(data.get("last_update_id", 0))
+
+    def reset_floor(self):
+        self.floor = self._high = 0
+
+    def begin(self, update_id: int) -> bool:
+        if update_id in self._recent:
+            self.duplicates += 1
+            return False
+        self._recent.add(update_id)
+        self._recent_order.append(update_id)
+        if len(self._recent_order) > self.RECENT_LIMIT * 2:
+            drop = self._recent_order[: self.RECENT_LIMIT]
+            del self._recent_order[: self.RECENT_LIMIT]
+            self._recent.difference_update(drop)
+        self._in_flight.add(update_id)
+        return True
+
+    def finish(self, update_id: int):
+        self._in_flight.discard(update_id)
+        self._high = max(self._high, update_id)
+
+    def processed_up_to(self) -> int:
+        # لا نتجاوز أقدم تحديث ما زال قيد المعالجة، حتى لا يضيع لو توقف البوت قبل إتمامه
+        if self._in_flight:
+            return max(self.floor, min(self._in_flight) - 1)
+        return self._high
+
+    def save(self):
+        self.saved_at = time.time()
+        WRITER.submit(_write_json, self.path, {"last_update_id": self.processed_up_to(), "saved_at": self.saved_at})
+
+
+UPDATE_OFFSET = UpdateOffset(UPDATE_OFFSET_FILE)
+
+
+async def _update_offset_loop():
+    while True:
+        await asyncio.sleep(UPDATE_OFFSET_SAVE_INTERVAL)
+        UPDATE_OFFSET.save()
+
+
+def update_timestamp(update: Update) -> float | None:
+    if update.chat_member:
+        return update.chat_member.date.timestamp()
+    if update.callback_query is None and update.effective_message:
+        return update.effective_message.date.timestamp()
+    return None
+
+
+async def catch_up(app: Application):
+    """
+    يسحب ما تراكم أثناء توقف البوت بدفعات getUpdates كبيرة ويعالجه بالتوازي عبر نفس معالج التحديثات.
+    ضغطات الأزرار لا تحمل وقتها، فتُعالج فقط إن ثبت أنها أحدث من STALE_CALLBACK_SECONDS:
+    وقتها بعد آخر حفظ للـ offset وبعد تاريخ آخر رسالة سبقتها في الطابور.
+    """
+    started = time.perf_counter()
+    # بدون offset في الطلب الأول: نرى أقدم تحديث غير مؤكد لنعرف هل أُعيد الترقيم
+    offset = None
+    known_after = UPDATE_OFFSET.saved_at or 0.0
+    duplicates = UPDATE_OFFSET.duplicates
+    tasks = []
+    stale = 0
+    try:
+        # getUpdates لا يعمل مع webhook مفعّل؛ الحذف بدون drop يُبقي الطابور كما هو
+        await app.bot.delete_webhook(drop_pending_updates=False)
+        while True:
+            updates = await app.bot.get_updates(
+                offset=offset, limit=100, timeout=0, allowed_updates=ALLOWED_UPDATES
+            )
+            if not updates:
+                # طلب بـ offset بعد آخر دفعة يؤكد استلامها لدى Telegram
+                break
+            if offset is None and updates[0].update_id < UPDATE_OFFSET.floor - 100:
+                logger.info(
+                    "Update ids restarted below saved offset %s (got %s); ignoring it",
+                    UPDATE_OFFSET.floor,
+                    updates[0].update_id,
+                )
+                UPDATE_OFFSET.reset_floor()
+            offset = updates[-1].update_id + 1
+            for update in updates:
+                if update.update_id <= UPDATE_OFFSET.floor:
+                    # عولج قبل التوقف ولم يُؤكد لدى Telegram
+                    UPDATE_OFFSET.duplicates += 1
+                    continue
+                if update.callback_query and time.time() - known_after > STALE_CALLBACK_SECONDS:
+                    stale += 1
+                    continue
+                known_after = max(known_after, update_timestamp(update) or 0.0)
+                tasks.append(asyncio.create_task(app.update_processor.process_update(update, app.process_update(update))))
+    except TelegramError as e:
+        logger.warning("Fetching pending updates failed: %s", e)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    UPDATE_OFFSET.save()
+    logger.info(
+        "Caught up on %s pending updates in %.2fs (%s stale callbacks skipped, %s duplicates)",
+        len(tasks) + stale,
+        time.perf_counter() - started,
+        stale,
+        UPDATE_OFFSET.duplicates - duplicates,
+    )
+
+
+# ================= اتصال Bot API =================
+def build_requests() -> tuple[HTTPXRequest, HTTPXRequest]:
+    """يبني اتصالات Bot API من متغيرات البيئة بعد التحقق منها، ويرجع (العادية، getUpdates)."""
+    settings = {
+        "BOT_API_POOL_SIZE": BOT_API_POOL_SIZE,
+        "BOT_API_GET_UPDATES_POOL_SIZE": BOT_API_GET_UPDATES_POOL_SIZE,
+        "BOT_API_CONNECT_TIMEOUT": BOT_API_CONNECT_TIMEOUT,
+        "BOT_API_READ_TIMEOUT": BOT_API_READ_TIMEOUT,
+        "BOT_API_WRITE_TIMEOUT": BOT_API_WRITE_TIMEOUT,
+        "BOT_API_MEDIA_WRITE_TIMEOUT": BOT_API_MEDIA_WRITE_TIMEOUT,
+        "BOT_API_POOL_TIMEOUT": BOT_API_POOL_TIMEOUT,
+    }
+    for name, value in settings.items():
+        if value <= 0:
+            raise RuntimeError(f"{name} must be positive, got {value}")
+
+    http_version = "1.1"
+    if BOT_API_HTTP2:
+        try:
+            import h2  # noqa: F401
+        except ImportError as exc:
+            raise RuntimeError('BOT_API_HTTP2 needs "python-telegram-bot[http2]"') from exc
+        # httpx لا يفاوض HTTP/2 إلا عبر TLS
+        if BOT_API_BASE_URL and not BOT_API_BASE_URL.startswith("https://"):
+            raise RuntimeError("BOT_API_HTTP2 needs an https:// BOT_API_BASE_URL")
+        http_version = "2"
+
+    # معالجات التحديثات وعمال الإذاعة قد يطلبون اتصالاً في نفس اللحظة
+    peak = CONCURRENT_UPDATES + BROADCAST_CONCURRENCY
+    if BOT_API_POOL_SIZE < peak:
+        logger.warning(
+            "BOT_API_POOL_SIZE=%s is below CONCURRENT_UPDATES + BROADCAST_CONCURRENCY = %s; "
+            "requests will queue for up to BOT_API_POOL_TIMEOUT=%ss",
+            BOT_API_POOL_SIZE,
+            peak,
+            BOT_API_POOL_TIMEOUT,
+        )
+
+    timeouts = {
+        "connect_timeout": BOT_API_CONNECT_TIMEOUT,
+        "read_timeout": BOT_API_READ_TIMEOUT,
+        "write_timeout": BOT_API_WRITE_TIMEOUT,
+        "media_write_timeout": BOT_API_MEDIA_WRITE_TIMEOUT,
+        "pool_timeout": BOT_API_POOL_TIMEOUT,
+    }
+    request = HTTPXRequest(connection_pool_size=BOT_API_POOL_SIZE, http_version=http_version, **timeouts)
+    # getUpdates طلب واحد طويل في كل مرة؛ مجمعه المستقل لا يزاحم الإذاعة ولا تزاحمه
+    get_updates_request = HTTPXRequest(
+        connection_pool_size=BOT_API_GET_UPDATES_POOL_SIZE, http_version=http_version, **timeouts
+    )
+    logger.info(
+        "Bot API transport: HTTP/%s, pool=%s (get_updates=%s), timeouts connect=%ss read=%ss write=%ss pool=%ss",
+        http_version,
+        BOT_API_POOL_SIZE,
+        BOT_API_GET_UPDATES_POOL_SIZE,
+        BOT_API_CONNECT_TIMEOUT,
+        BOT_API_READ_TIMEOUT,
+        BOT_API_WRITE_TIMEOUT,
+        BOT_API_POOL_TIMEOUT,
+    )
+    return request, get_updates_request
+
+
+# ================= وضع Webhook =================
+# تحديثات chat_member لا تصل إلا إذا طُلبت صراحة
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.CHAT_MEMBER]
+
+
+def webhook_secret() -> str:
+    # ثابت بين عمليات إعادة النشر دون الحاجة لمتغير إضافي، ويمكن تحديده عبر WEBHOOK_SECRET
+    return os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()[:48]
+
+
+def build_webhook_server(app: Application, secret: str):
+    """
+    خادم tornado واحد على نفس المنفذ: مسار الـ webhook يتحقق من
+    X-Telegram-Bot-Api-Secret-Token ثم يضع التحديث في طابور التطبيق،
+    و HEALTH_PATH يعيد حالة البوت لفحوصات المنصة.
+    """
+    try:
+        import tornado.httpserver
+        import tornado.web
+    except ImportError as exc:
+        raise RuntimeError('Webhook mode needs "python-telegram-bot[webhooks]"') from exc
+
+    started_at = time.monotonic()
+
+    class WebhookHandler(tornado.web.RequestHandler):
+        async def post(self):
+            token = self.request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(token, secret):
+                self.set_status(403)
+                return
+            try:
+                update = Update.de_json(json.loads(self.request.body), app.bot)
+            except (ValueError, TypeError):
+                self.set_status(400)
+                return
+            await app.update_queue.put(update)
+            self.set_status(200)
+
+    class HealthHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.write(
+                {
+                    "status": "ok" if app.running else "starting",
+                    "uptime": round(time.monotonic() - started_at, 1),
+                    "update_queue": app.update_queue.qsize(),
+                    "users": len(USER_STORE),
+                }
+            )
+
+    web_app = tornado.web.Application([(f"/{WEBHOOK_PATH}", WebhookHandler), (HEALTH_PATH, HealthHandler)])
+    return tornado.httpserver.HTTPServer(web_app, xheaders=True)
+
+
+async def run_webhook(app: Application):
+    secret = webhook_secret()
+    server = build_webhook_server(app, secret)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # نفس ترتيب run_polling: initialize ثم post_init ثم start، والعكس عند الإيقاف (stop ثم post_stop ثم shutdown)
+    await app.initialize()
+    await post_init(app)
+    await app.start()
+    server.listen(WEBHOOK_PORT)
+    try:
+        await app.bot.set_webhook(
+            url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+            secret_token=secret,
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=STARTUP_UPDATES != "replay",
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        logger.info("Webhook mode on port %s", WEBHOOK_PORT)
+        await stop.wait()
+    finally:
+        server.stop()
+        await app.stop()
+        await post_stop(app)
+        await app.shutdown()
+        await post_shutdown(app)
+
+
 def main():
+    if sys.argv[1:] == ["import-json"]:
+        counts = import_json_to_sqlite()
+        print(f"Imported into {SQLITE_FILE}: " + ", ".join(f"{k}={v}" for k, v in counts.items()))
+        return
+
     if not BOT_TOKEN:
         raise RuntimeError("Missing BOT_TOKEN environment variable")
-
-    app = Application.builder().token(BOT_TOKEN).build()
+    if CONCURRENT_UPDATES < 1:
+        raise RuntimeError(f"CONCURRENT_UPDATES must be at least 1, got {CONCURRENT_UPDATES}")
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.INFO)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("tornado.access").setLevel(logging.WARNING)
+
+    request, get_updates_request = build_requests()
+    load_storage()
+
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .rate_limiter(SEND_GUARD)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL)
+    app = builder.build()
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CallbackQueryHandler(on_button))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_amount))
+    app.add_handler(MessageHandler(filters.PHOTO | filters.VIDEO | filters.Document.ALL, handle_media))
+    app.add_handler(ChatMemberHandler(on_chat_member, ChatMemberHandler.CHAT_MEMBER))
+
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(app))
+        return
 
-    app.run_polling(drop_pending_updates=True)
+    app.run_polling(drop_pending_updates=STARTUP_UPDATES != "replay", allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,248 @@
+"""
+إعادة تشغيل تحديثات مسجلة على البوت محلياً وقياس الزمن من وصول التحديث حتى الرد.
+
+    python replay_updates.py [--mode webhook|polling] [--updates ملف.jsonl] [--count 500] [--concurrency 50]
+
+الأداة تشغّل خادم Bot API وهمياً، ثم تشغّل main.py كعملية فرعية موجهة إليه عبر
+BOT_API_BASE_URL وببيانات في مجلد مؤقت:
+- webhook: ترسل كل تحديث POST إلى مسار الـ webhook مع الـ secret token.
+- polling: تقدّم التحديثات للبوت عبر getUpdates.
+- مع --backlog تكون التحديثات في طابور getUpdates قبل تشغيل البوت، لقياس اللحاق بها عند التشغيل.
+زمن الرد = أول sendMessage/editMessageText للمحادثة ناقص لحظة تقديم تحديثها.
+كل طلب للخادم الوهمي يتأخر --api-latency لمحاكاة زمن الشبكة إلى Telegram.
+بدون --updates تُولَّد رسائل /start من مستخدمين مختلفين.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import tornado.httpserver
+import tornado.web
+
+TOKEN = "123456:REPLAY"
+REPLY_METHODS = {"sendMessage", "editMessageText", "sendPhoto", "sendVideo", "sendDocument"}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def generate_updates(count: int) -> list[dict]:
+    now = int(time.time())
+    updates = []
+    for i in range(count):
+        user = {"id": 500_000 + i, "is_bot": False, "first_name": f"Replay {i}", "username": f"replay{i}"}
+        updates.append(
+            {
+                "update_id": 1_000 + i,
+                "message": {
+                    "message_id": i + 1,
+                    "date": now,
+                    "chat": {"id": user["id"], "type": "private"},
+                    "from": user,
+                    "text": "/start",
+                    "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+                },
+            }
+        )
+    return updates
+
+
+def load_updates(path: str) -> list[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def update_chat_id(update: dict) -> int | None:
+    for key in ("message", "edited_message", "callback_query"):
+        item = update.get(key)
+        if not item:
+            continue
+        if key == "callback_query":
+            return item["from"]["id"]
+        return item["chat"]["id"]
+    return None
+
+
+class FakeBotApi:
+    """يرد على طلبات البوت بأقل JSON صالح ويسجل وقت أول رد لكل محادثة."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.pending: list[dict] = []
+        self.fed_at: dict[int, float] = {}
+        self.replied_at: dict[int, float] = {}
+        self.message_id = 0
+        self.polling = asyncio.Event()  # أول getUpdates طويل = انتهى تشغيل البوت
+
+    def feed(self, update: dict):
+        chat_id = update_chat_id(update)
+        if chat_id is not None:
+            self.fed_at.setdefault(chat_id, time.perf_counter())
+
+    def handle(self, method: str, params: dict):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+        if method == "getUpdates":
+            if float(params.get("timeout") or 0) > 0:
+                self.polling.set()
+            batch, self.pending = self.pending[:100], self.pending[100:]
+            for update in batch:
+                self.feed(update)
+            return batch
+        if method == "getChatMember":
+            return {"status": "member", "user": {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "x"}}
+        if method in REPLY_METHODS:
+            chat_id = int(params.get("chat_id", 0))
+            self.replied_at.setdefault(chat_id, time.perf_counter())
+            self.message_id += 1
+            return {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        return True
+
+    def make_app(self) -> tornado.web.Application:
+        api = self
+
+        class Handler(tornado.web.RequestHandler):
+            async def post(self, method):
+                params = {k: self.get_body_argument(k) for k in self.request.body_arguments}
+                if not params and self.request.body and self.request.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(self.request.body)
+                if method == "getUpdates" and not api.pending:
+                    await asyncio.sleep(0.05)
+                elif api.latency:
+                    await asyncio.sleep(api.latency)
+                self.write({"ok": True, "result": api.handle(method, params)})
+
+        return tornado.web.Application([(rf"/bot{TOKEN}/(\w+)", Handler)])
+
+
+async def wait_for_health(url: str, proc: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError("Bot process exited during startup")
+            try:
+                if (await client.get(url)).json().get("status") == "ok":
+                    return
+            except (httpx.HTTPError, ValueError):
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Bot did not become healthy in time")
+
+
+async def post_updates(url: str, secret: str, updates: list[dict], api: FakeBotApi, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+    async with httpx.AsyncClient(timeout=30) as client:
+
+        async def post(update: dict):
+            async with semaphore:
+                api.feed(update)
+                response = await client.post(url, json=update, headers=headers)
+                response.raise_for_status()
+
+        await asyncio.gather(*(post(update) for update in updates))
+
+
+def report(api: FakeBotApi, total: int, started: float):
+    latencies = sorted(
+        api.replied_at[chat_id] - fed for chat_id, fed in api.fed_at.items() if chat_id in api.replied_at
+    )
+    elapsed = time.perf_counter() - started
+    print(f"updates: {total}, replied: {len(latencies)}, wall time: {elapsed:.2f}s")
+    if latencies:
+        def pct(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+        print(f"latency ms  p50={pct(0.5):.1f}  p90={pct(0.9):.1f}  p99={pct(0.99):.1f}  max={latencies[-1] * 1000:.1f}")
+
+
+async def run(args):
+    updates = load_updates(args.updates) if args.updates else generate_updates(args.count)
+    api = FakeBotApi(args.api_latency / 1000)
+    api_port = free_port()
+    api_server = tornado.httpserver.HTTPServer(api.make_app())
+    api_server.listen(api_port, "127.0.0.1")
+
+    bot_port = free_port()
+    env = dict(
+        os.environ,
+        BOT_TOKEN=TOKEN,
+        BOT_API_BASE_URL=f"http://127.0.0.1:{api_port}/bot",
+        DATA_DIR=tempfile.mkdtemp(prefix="replay-"),
+        PORT=str(bot_port),
+        WEBHOOK_SECRET="replay-secret",
+    )
+    env.pop("ADMIN_ID", None)
+    if args.mode == "webhook":
+        env["WEBHOOK_URL"] = f"http://127.0.0.1:{bot_port}"
+    else:
+        env.pop("WEBHOOK_URL", None)
+
+    main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    if args.backlog:
+        started = time.perf_counter()
+        api.pending = list(updates)
+    proc = subprocess.Popen([sys.executable, main_py], env=env)
+    try:
+        # مع --backlog التحديثات في طابور getUpdates منذ ما قبل التشغيل
+        if not args.backlog and args.mode == "webhook":
+            await wait_for_health(f"http://127.0.0.1:{bot_port}/healthz", proc)
+            started = time.perf_counter()
+            path = (env.get("WEBHOOK_PATH") or "telegram").strip("/")
+            await post_updates(f"http://127.0.0.1:{bot_port}/{path}", "replay-secret", updates, api, args.concurrency)
+        elif not args.backlog:
+            await asyncio.wait_for(api.polling.wait(), 30)
+            started = time.perf_counter()
+            api.pending = list(updates)
+
+        deadline = time.monotonic() + args.timeout
+        expected = len({update_chat_id(u) for u in updates} - {None})
+        while len(api.replied_at) < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        report(api, len(updates), started)
+        if args.backlog:
+            # الإيقاف قبل انتهاء التشغيل يقطع PTB في منتصف bootstrap
+            if args.mode == "webhook":
+                await wait_for_health(f"http://127.0.0.1:{bot_port}/healthz", proc)
+            else:
+                await asyncio.wait_for(api.polling.wait(), 30)
+    finally:
+        proc.terminate()
+        try:
+            # الانتظار في خيط منفصل: البوت يحتاج الخادم الوهمي أثناء إيقافه
+            await asyncio.to_thread(proc.wait, 15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        api_server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("webhook", "polling"), default="webhook")
+    parser.add_argument("--updates", help="ملف JSONL فيه تحديث Telegram في كل سطر")
+    parser.add_argument("--count", type=int, default=500, help="عدد التحديثات المولدة عند غياب --updates")
+    parser.add_argument("--concurrency", type=int, default=50, help="عدد طلبات POST المتزامنة في وضع webhook")
+    parser.add_argument("--backlog", action="store_true", help="وضع التحديثات في الطابور قبل تشغيل البوت")
+    parser.add_argument("--api-latency", type=float, default=50, help="تأخير كل طلب Bot API بالمللي ثانية لمحاكاة الشبكة")
+    parser.add_argument("--timeout", type=float, default=120, help="أقصى انتظار للردود بالثواني")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()